@@ -74,6 +74,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'AnimationBoard.wsgi.application'
 
+# 可选的缓存配置。例如把oss签名缓存的共享后端放在/dev/shm上的FileBasedCache中
+if hasattr(config, 'CACHES'):
+    CACHES = config.CACHES
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.BasicAuthentication',
@@ -91,6 +95,19 @@ REST_FRAMEWORK = {
 CRONJOBS = []
 if config.AUTO_UPDATE_SETTINGS['enable']:
     CRONJOBS.append((config.AUTO_UPDATE_SETTINGS['interval'], 'api.tasks.delivery_publish_task'))
+# 较早的配置文件中没有消息归档的配置，缺少的项使用默认值
+MESSAGE_ARCHIVE_SETTINGS = dict({
+    'enable': False,
+    'interval': '30 4 * * *',
+    'days': 90,
+    'batch_size': 1000
+}, **getattr(config, 'MESSAGE_ARCHIVE_SETTINGS', {}))
+if MESSAGE_ARCHIVE_SETTINGS['enable']:
+    CRONJOBS.append((MESSAGE_ARCHIVE_SETTINGS['interval'], 'api.tasks.message_archive_task'))
+# 清理因服务进程重启而丢失的封面处理
+CRONJOBS.append(('0 * * * *', 'api.tasks.cover_sweep_task'))
+# 继续投递因服务进程重启而中断的系统通知群发
+CRONJOBS.append(('*/10 * * * *', 'api.tasks.broadcast_resume_task'))
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
@@ -146,3 +163,11 @@ STATICFILES_DIRS = [
 ]
 STATIC_URL = '/%sstatic/' % (config.URL_PREFIX,)
 COVER_DIRS = os.path.join(BASE_DIR, 'static/' + config.COVER_STORAGE['FILEPATH'])
+COVER_CACHE_DIRS = os.path.join(BASE_DIR, config.COVER_STORAGE.get('VARIANT_CACHE', {}).get('PATH', 'cache/cover'))
+# 超过此大小的上传由Django写入临时文件，与封面处理在内存中暂存的上限一致
+FILE_UPLOAD_MAX_MEMORY_SIZE = config.COVER_STORAGE.get('MEMORY_MAX_SIZE', 10 * 1024 * 1024)
+
+
+def WHITENOISE_IMMUTABLE_FILE_TEST(path, url):
+    # 封面的文件名带有uuid，内容不会改变
+    return url.startswith('%s%s/' % (STATIC_URL, config.COVER_STORAGE['FILEPATH']))
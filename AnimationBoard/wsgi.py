@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AnimationBoard.settings')
 
 application = get_wsgi_application()
+
+# 服务进程启动时预先构建输入提示的索引
+from api import suggest
+suggest.warm_up()
@@ -0,0 +1,497 @@
+"""
+封面图片的处理与存储。
+上传的图片暂存后交给后台的进程池，由工作进程解码、裁切、缩放和编码，再直接写入storage.get_storage()返回的存储后端。
+FILE_UPLOAD_MAX_MEMORY_SIZE与COVER_STORAGE['MEMORY_MAX_SIZE']一致：不超过它的上传在内存中暂存，
+超过的上传由Django写入临时文件，暂存时直接移动这个文件。
+处理期间新的封面名记录在cover_pending字段上，处理完成后才替换cover；服务进程重启而丢失的处理由cover_sweep命令清理。
+每次上传除了384px的JPEG原图，还会生成VARIANT_SIZES与VARIANT_FORMATS组合出的各个变体，
+变体的文件名是在原图文件名的基础上加上"@<size>.<format>"。
+没有预先生成的变体(例如早于变体功能上传的封面)会在第一次被请求时生成，保存在本地磁盘的缓存中。
+解码之前先检查字节数与像素数的上限；JPEG使用draft模式按需要的尺寸缩小解码，使每次处理占用的内存有界。
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from datetime import timedelta
+from AnimationBoard.settings import COVER_CACHE_DIRS
+from PIL import Image
+from . import models as app_models, relations as app_relations
+from .storage import get_storage
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import config
+import django
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+COVER_SIZE = 384
+STASH_PREFIX = 'cover-stash-'
+WORKERS = config.COVER_STORAGE.get('WORKERS', 2)
+VARIANT_SIZES = tuple(config.COVER_STORAGE.get('VARIANT_SIZES', (96, 192, 384, 768)))
+VARIANT_FORMATS = tuple(config.COVER_STORAGE.get('VARIANT_FORMATS', ('jpg', 'webp')))
+MAX_BYTES = config.COVER_STORAGE.get('MAX_BYTES', 32 * 1024 * 1024)
+MAX_PIXELS = config.COVER_STORAGE.get('MAX_PIXELS', 50 * 1000 * 1000)
+VARIANT_CACHE_MAX_SIZE = config.COVER_STORAGE.get('VARIANT_CACHE', {}).get('MAX_SIZE', 256 * 1024 * 1024)
+# 格式 -> (Pillow的格式名, content type)
+FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp')
+}
+
+
+class ImageRejected(ValueError):
+    """图片无法识别，或者超过了大小限制。"""
+    pass
+
+
+class Stats(object):
+    """记录解码与编码的耗时。工作进程中的耗时随处理结果返回，在本进程中汇总。"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.decode_total = 0.0
+        self.decode_max = 0.0
+        self.encode_total = 0.0
+        self.encode_max = 0.0
+
+    def record(self, timings):
+        with self.lock:
+            self.count += 1
+            self.decode_total += timings['decode']
+            self.decode_max = max(self.decode_max, timings['decode'])
+            self.encode_total += timings['encode']
+            self.encode_max = max(self.encode_max, timings['encode'])
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'decode_avg': self.decode_total / self.count if self.count > 0 else None,
+                'decode_max': self.decode_max,
+                'encode_avg': self.encode_total / self.count if self.count > 0 else None,
+                'encode_max': self.encode_max
+            }
+
+
+stats = Stats()
+
+
+def stash_upload(file):
+    """
+    将上传的文件暂存起来，以便交给工作进程。
+    超过FILE_UPLOAD_MAX_MEMORY_SIZE的上传已经由Django写入了临时文件，直接移动该文件，不再复制；
+    其余的上传在内存中，读出为bytes。
+    :param file: request.FILES中的UploadedFile。
+    :return: bytes；或者临时文件的路径，由工作进程负责删除。
+    :raise ImageRejected: 超过MAX_BYTES。
+    """
+    if file.size is not None and file.size > MAX_BYTES:
+        raise ImageRejected('Image is larger than %s bytes.' % (MAX_BYTES,))
+    if hasattr(file, 'temporary_file_path'):
+        fd, path = tempfile.mkstemp(prefix=STASH_PREFIX)
+        os.close(fd)
+        # 移动之后Django关闭上传文件时找不到原文件，会忽略这个错误
+        shutil.move(file.temporary_file_path(), path)
+        return path
+    buffer = io.BytesIO()
+    total = 0
+    for c in file.chunks():
+        total += len(c)
+        if total > MAX_BYTES:
+            raise ImageRejected('Image is larger than %s bytes.' % (MAX_BYTES,))
+        buffer.write(c)
+    return buffer.getvalue()
+
+
+def variant_name(name, size, fmt):
+    """
+    变体的文件名。384px的JPEG就是原图本身。
+    """
+    if size == COVER_SIZE and fmt == 'jpg':
+        return name
+    return '%s@%s.%s' % (os.path.splitext(name)[0], size, fmt)
+
+
+def is_safe_name(name):
+    """文件名中不含路径，可以安全地拼接到存储目录下。"""
+    return os.path.basename(name) == name and not name.startswith('.')
+
+
+def content_type(name):
+    fmt = os.path.splitext(name)[1][1:]
+    return FORMATS[fmt][1] if fmt in FORMATS else 'application/octet-stream'
+
+
+def variants():
+    """
+    :return: 除原图之外需要生成的全部(size, format)。
+    """
+    return [(size, fmt) for size in VARIANT_SIZES for fmt in VARIANT_FORMATS
+            if fmt in FORMATS and not (size == COVER_SIZE and fmt == 'jpg')]
+
+
+def open_image(source):
+    """
+    打开图片。只读取文件头，不解码像素。
+    :raise ImageRejected: 无法识别，或者像素数超过MAX_PIXELS。
+    """
+    try:
+        img = Image.open(source)
+    except Image.DecompressionBombError:
+        # 像素数远超Pillow自身的上限时，Image.open已经拒绝打开
+        raise ImageRejected('Image has more than %s pixels.' % (MAX_PIXELS,))
+    except (OSError, SyntaxError):
+        raise ImageRejected('Cannot identify image.')
+    width, height = img.size
+    if width * height > MAX_PIXELS:
+        # source是路径时文件由Image.open打开，拒绝时要关闭
+        img.close()
+        raise ImageRejected('Image has more than %s pixels.' % (MAX_PIXELS,))
+    return img
+
+
+def analyse_image(source, targets, timings=None):
+    """
+    将图片裁剪成正方形，缩放并编码成每一个目标尺寸和格式。
+    :param source: 文件路径或文件对象。
+    :param targets: [(size, format)]
+    :param timings: 提供dict时，写入解码(decode)与编码(encode)的秒数。
+    :return: {(size, format): bytes}
+    """
+    start = time.perf_counter()
+    img = open_image(source)
+    max_size = max(size for size, _ in targets)
+    # JPEG在DCT阶段就可以按1/2、1/4、1/8缩小，只解码出不小于最大目标尺寸的图像
+    img.draft('RGB', (max_size, max_size))
+    # 裁剪成正方形
+    width, height = img.size
+    if width > height:
+        img = img.crop(((width - height) / 2, 0, (width + height) / 2, height))
+    elif width < height:
+        img = img.crop((0, (height - width) / 2, width, (height + width) / 2))
+    img = img.convert('RGB')
+    # 其他格式只能完整解码，再用整数倍的快速缩小减少后续重采样的代价
+    factor = img.size[0] // max_size
+    if factor >= 2 and hasattr(img, 'reduce'):
+        img = img.reduce(factor)
+    decoded = time.perf_counter()
+    result = {}
+    # 从大到小依次缩放，较小的尺寸从上一个尺寸的结果继续缩放
+    for size in sorted(set(size for size, _ in targets), reverse=True):
+        img.thumbnail((size, size))
+        for s, fmt in targets:
+            if s == size:
+                buffer = io.BytesIO()
+                img.save(buffer, format=FORMATS[fmt][0])
+                result[(size, fmt)] = buffer.getvalue()
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['encode'] = time.perf_counter() - decoded
+    return result
+
+
+def save(name, data):
+    """将编码好的图片写入存储。"""
+    get_storage().put(name, data)
+
+
+def delete(name):
+    """删除一个封面和它的全部变体。"""
+    get_storage().batch_delete([name] + [variant_name(name, size, fmt) for size, fmt in variants()])
+    exists.cache_clear()
+
+
+@lru_cache(maxsize=4096)
+def exists(name):
+    return get_storage().exists(name)
+
+
+def load(name):
+    """
+    从存储中读取一个文件。
+    :return: bytes；不存在时返回None。
+    """
+    return get_storage().get(name)
+
+
+class VariantCache(object):
+    """
+    本地磁盘上的变体缓存，按总字节数做LRU淘汰。
+    文件的mtime用作最近访问时间，命中时刷新，因此多个进程共用同一个目录时淘汰顺序仍然一致。
+    各进程只累计自己写入的字节数，超过上限时重新扫描目录得到准确的总量再淘汰。
+    同一个key同时只有一个线程在生成，其余线程等待它的结果。
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.key_locks = {}     # key -> [Lock, 等待数]
+        self.total = None
+
+    def get(self, key, render):
+        """
+        :param key: 变体的文件名。
+        :param render: 生成变体内容的函数，返回bytes或None。
+        :return: 缓存文件的路径；render返回None时返回None。
+        """
+        path = os.path.join(self.path, key)
+        if self.touch(path):
+            return path
+        key_lock = self.acquire(key)
+        try:
+            with key_lock:
+                if self.touch(path):
+                    return path
+                data = render()
+                if data is None:
+                    return None
+                self.write(path, data)
+        finally:
+            self.release(key)
+        with self.lock:
+            if self.total is not None:
+                self.total += len(data)
+            if self.total is None or self.total > self.max_size:
+                self.evict()
+        return path
+
+    @staticmethod
+    def touch(path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def write(self, path, data):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        # 先写入临时文件再改名，其他进程不会读到写了一半的文件
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def acquire(self, key):
+        with self.lock:
+            item = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            item[1] += 1
+            return item[0]
+
+    def release(self, key):
+        with self.lock:
+            item = self.key_locks[key]
+            item[1] -= 1
+            if item[1] <= 0:
+                del self.key_locks[key]
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.startswith('.'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
+
+
+variant_cache = VariantCache(COVER_CACHE_DIRS, VARIANT_CACHE_MAX_SIZE)
+
+
+def choose_variant(name, size=None, fmt=None):
+    """
+    为请求选择最合适的变体：不小于size的最小尺寸，指定的格式。
+    已经存储的变体直接使用；没有的在第一次请求时从原图生成，放入本地缓存。
+    :param name: 原图文件名。
+    :param size: 期望的尺寸，None表示原图尺寸。
+    :param fmt: 期望的格式，None表示jpg。
+    :return: (文件名, 本地缓存文件的路径)。使用存储中的文件时路径为None。
+    """
+    if (size is None and fmt is None) or not is_safe_name(name):
+        return name, None
+    if size is None:
+        size = COVER_SIZE
+    else:
+        sizes = sorted(set(VARIANT_SIZES + (COVER_SIZE,)))
+        size = next((s for s in sizes if s >= size), sizes[-1])
+    fmt = fmt if fmt in VARIANT_FORMATS and fmt in FORMATS else 'jpg'
+    candidate = variant_name(name, size, fmt)
+    if candidate == name or exists(candidate):
+        return candidate, None
+
+    def render():
+        data = load(name)
+        if data is None:
+            return None
+        timings = {}
+        try:
+            image = analyse_image(io.BytesIO(data), [(size, fmt)], timings)[(size, fmt)]
+        except ImageRejected:
+            return None
+        stats.record(timings)
+        return image
+
+    path = variant_cache.get(candidate, render)
+    if path is None:
+        return name, None
+    return candidate, path
+
+
+def process(name, source):
+    """
+    在工作进程中执行：处理暂存的上传，保存为name及其全部变体。
+    :param name:
+    :param source: stash_upload的返回值。
+    :return: 解码与编码的耗时。
+    """
+    try:
+        targets = [(COVER_SIZE, 'jpg')] + variants()
+        timings = {}
+        images = analyse_image(io.BytesIO(source) if isinstance(source, bytes) else source, targets, timings)
+        for (size, fmt), data in images.items():
+            save(variant_name(name, size, fmt), data)
+        return timings
+    finally:
+        if not isinstance(source, bytes) and os.path.exists(source):
+            os.remove(source)
+
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor(renew=False):
+    """
+    服务进程中有多个线程，直接fork出的工作进程可能继承其他线程持有的锁。
+    因此工作进程由forkserver(不支持时用spawn)启动，启动后先初始化Django。
+    """
+    global executor
+    with executor_lock:
+        if executor is None or renew:
+            if not get_storage().SHARED:
+                # 存储只存在于本进程中(memory)，工作进程写入的内容本进程看不到，改为在线程中处理
+                executor = ThreadPoolExecutor(max_workers=WORKERS)
+            else:
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                executor = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context(method),
+                                               initializer=django.setup)
+        return executor
+
+
+def submit(instance, new_cover_name, file):
+    """
+    接受一次封面上传：标记cover_pending，然后交给进程池处理。
+    :param instance: Animation或Profile。
+    :param new_cover_name:
+    :param file: request.FILES中的UploadedFile。
+    :return:
+    :raise ImageRejected:
+    """
+    model, pk = type(instance), instance.pk
+    source = stash_upload(file)
+    # 在请求中只读取文件头，不符合要求的图片直接拒绝
+    try:
+        open_image(io.BytesIO(source) if isinstance(source, bytes) else source).close()
+    except ImageRejected:
+        if not isinstance(source, bytes):
+            os.remove(source)
+        raise
+    now = timezone.now()
+    model.objects.filter(pk=pk).update(cover_pending=new_cover_name, cover_pending_time=now)
+    instance.cover_pending = new_cover_name
+    instance.cover_pending_time = now
+    try:
+        future = get_executor().submit(process, new_cover_name, source)
+    except BrokenProcessPool:
+        # 某个工作进程异常退出后整个进程池不再可用，换一个新的
+        future = get_executor(renew=True).submit(process, new_cover_name, source)
+    future.add_done_callback(lambda f: finish(model, pk, new_cover_name, f.exception(),
+                                              f.result() if f.exception() is None else None))
+
+
+def finish(model, pk, new_cover_name, error, timings=None):
+    """
+    一次处理结束后调用。成功时用新封面替换cover，删除旧封面，并扩散到关系网络的缓存。
+    处理期间有更新的上传时，cover_pending已经不是new_cover_name，这次的结果作废。
+    """
+    if timings is not None:
+        stats.record(timings)
+    if error is not None:
+        logger.error('Processing cover %s of %s %s failed: %r', new_cover_name, model.__name__, pk, error)
+    try:
+        with transaction.atomic():
+            instance = model.objects.select_for_update().filter(pk=pk, cover_pending=new_cover_name).first()
+            if instance is None:
+                if error is None:
+                    delete(new_cover_name)
+                return
+            old_cover_name = instance.cover
+            instance.cover_pending = None
+            instance.cover_pending_time = None
+            if error is None:
+                instance.cover = new_cover_name
+            instance.save(update_fields=['cover', 'cover_pending', 'cover_pending_time'])
+        if error is not None:
+            return
+        if old_cover_name is not None:
+            delete(old_cover_name)
+        if model is app_models.Animation:
+            # 将文件名扩散到所有的缓存。相关的animation可能也在结束处理，按id顺序加锁，并且只写回relations，
+            # 否则会用读到的旧值覆盖它们刚写入的cover
+            with transaction.atomic():
+                related = app_models.Animation.objects.select_for_update().order_by('id')
+                app_relations.spread_cache_field(instance.id, instance.relations,
+                                                 lambda id_list: related.filter(id__in=id_list),
+                                                 'cover', new_cover_name,
+                                                 save_action=lambda a: a.save(update_fields=['relations']))
+    finally:
+        # 回调在进程池的管理线程中执行，不处于请求周期中，用完立即归还连接
+        connection.close()
+
+
+def sweep(max_age):
+    """
+    清理丢失的处理任务。任务只存在于接受上传的服务进程中，进程重启后任务丢失，cover_pending不会再被清除。
+    开始处理超过max_age秒的cover_pending被清除，已经写入的部分文件被删除；超过max_age秒的暂存文件也被删除。
+    :return: (清除的cover_pending数, 删除的暂存文件数)
+    """
+    deadline = timezone.now() - timedelta(seconds=max_age)
+    pending_count = 0
+    for model in (app_models.Animation, app_models.Profile):
+        stale = model.objects.filter(Q(cover_pending_time__lt=deadline) | Q(cover_pending_time__isnull=True),
+                                     cover_pending__isnull=False).values_list('pk', 'cover_pending')
+        for pk, name in stale:
+            # 只有cover_pending仍然是这个任务时才清除，清除之后处理才结束的任务会自行作废
+            if model.objects.filter(pk=pk, cover_pending=name).update(cover_pending=None, cover_pending_time=None):
+                delete(name)
+                pending_count += 1
+    stash_count = 0
+    stash_deadline = time.time() - max_age
+    for entry in os.scandir(tempfile.gettempdir()):
+        if entry.name.startswith(STASH_PREFIX) and entry.is_file() and entry.stat().st_mtime < stash_deadline:
+            try:
+                os.remove(entry.path)
+                stash_count += 1
+            except FileNotFoundError:
+                pass
+    return pending_count, stash_count
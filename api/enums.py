@@ -41,6 +41,13 @@ DIARY_STATUS_CHOICE = (
     ('GIVEUP', 'GiveUp')
 )
 
+BROADCAST_STATUS_CHOICE = (
+    ('PENDING', 'Pending'),
+    ('RUNNING', 'Running'),
+    ('DONE', 'Done'),
+    ('FAILED', 'Failed')
+)
+
 GLOBAL_SETTING_REGISTER_MODE_CHOICE = (
     ('CLOSE', 'Close'),
     ('ONLY_CODE', 'OnlyCode'),
@@ -74,6 +81,13 @@ class DiaryStatus:
     give_up = 'GIVEUP'
 
 
+class BroadcastStatus:
+    pending = 'PENDING'
+    running = 'RUNNING'
+    done = 'DONE'
+    failed = 'FAILED'
+
+
 class GlobalSettingRegisterMode:
     close = 'CLOSE'
     only_code = 'ONLY_CODE'
@@ -0,0 +1,116 @@
+"""
+animation浏览页的分面计数。
+对筛选后的animation，用一条GROUPING SETS查询同时统计各个分面下每个值的数量。
+结果按筛选参数缓存在进程内，任何进程写入animation、tag或staff后，通过notify的database频道清空缓存。
+"""
+from django.db import connections
+from collections import OrderedDict
+from . import notify
+import threading
+
+FACETS = ('original_work_type', 'publish_type', 'limit_level', 'season', 'tag')
+
+# 季度的格式与statistics.get_season_key一致：只有1、4、7、10月开播的才属于某个季度
+# 筛选后的animation查询拼接在FACET_SQL_HEAD与FACET_SQL_TAIL之间，它的参数原样传给execute
+FACET_SQL_HEAD = """
+    select grouping(f.original_work_type, f.publish_type, f.limit_level, f.season, t.name) as mask,
+           f.original_work_type, f.publish_type, f.limit_level, f.season, t.name, count(distinct f.id)
+    from (
+      select a.id, a.original_work_type, a.publish_type, a.limit_level, a.tag_ids,
+             case when extract(month from a.publish_time) in (1, 4, 7, 10)
+                  then concat(extract(year from a.publish_time)::int, '-',
+                              (extract(month from a.publish_time)::int - 1) / 3)
+             end as season
+      from (
+"""
+FACET_SQL_TAIL = """
+      ) a
+    ) f
+    left join lateral (
+      select tag.name from api_tag tag where tag.id = any(f.tag_ids)
+    ) t on true
+    group by grouping sets ((f.original_work_type), (f.publish_type), (f.limit_level), (f.season), (t.name))
+"""
+
+
+def count(queryset):
+    """
+    :param queryset: 已经筛选过的animation queryset。
+    :return: {分面: [{value, count}]}，每个分面内按数量倒序。
+    """
+    queryset = queryset.order_by().values('id', 'original_work_type', 'publish_type', 'limit_level',
+                                          'publish_time', 'tag_ids')
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    result = OrderedDict((facet, []) for facet in FACETS)
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(FACET_SQL_HEAD + sql + FACET_SQL_TAIL, params)
+        for row in cursor.fetchall():
+            mask, values, number = row[0], row[1:-1], row[-1]
+            # grouping()的结果中，没有参与分组的列对应的位为1，第一列是最高位
+            for i, facet in enumerate(FACETS):
+                if not mask & (1 << (len(FACETS) - 1 - i)):
+                    if facet != 'tag' or values[i] is not None:
+                        result[facet].append({'value': values[i], 'count': number})
+                    break
+    for items in result.values():
+        items.sort(key=lambda item: -item['count'])
+    return result
+
+
+class FacetCache(object):
+    """
+    以筛选参数为key的LRU缓存。generation在每次失效时递增，
+    计算期间发生了失效的结果不会被存入，避免缓存写入之前的旧数据。
+    """
+    MAX_SIZE = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.generation = 0
+
+    @staticmethod
+    def signature(params, ignore=()):
+        return tuple(sorted((k, tuple(sorted(params.getlist(k)))) for k in params.keys() if k not in ignore))
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value, self.generation
+
+    def put(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.MAX_SIZE:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.generation += 1
+
+    def on_notify(self, payload):
+        kind = payload.split(':')[0]
+        if kind in ('animation', 'tag', 'staff'):
+            self.clear()
+
+
+cache = FacetCache()
+cache_lock = threading.Lock()
+subscribed = False
+
+
+def get_cache():
+    """获得本进程的缓存。第一次调用时订阅写入通知。"""
+    global subscribed
+    if not subscribed:
+        with cache_lock:
+            if not subscribed:
+                notify.listener.subscribe(notify.CHANNEL_DATABASE, cache.on_notify, cache.clear)
+                subscribed = True
+    return cache
@@ -1,7 +1,11 @@
 import django_filters
 from django_filters.constants import EMPTY_VALUES
 from django import forms
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
+from rest_framework import filters as rest_filters
 from . import models as app_models
+from collections import OrderedDict
 
 
 class EachSearchFilter(django_filters.Filter):
@@ -56,6 +60,77 @@ class ArrayFilter(django_filters.Filter):
         return self.get_method(qs)(**{lookup: array})
 
 
+class ArrayContainFilter(django_filters.NumberFilter):
+    """要求数组字段包含给定的值。值必须是整数，否则返回400。"""
+    field_class = forms.IntegerField
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+        if self.distinct:
+            qs = qs.distinct()
+        return self.get_method(qs)(**{'%s__contains' % (self.field_name,): [value]})
+
+
+class EachArrayFilter(django_filters.Filter):
+    """
+    与EachSearchFilter的匹配规则相同，但作用于维护好的id数组字段。
+    先在related_model上按related_field解析出每一项对应的id，再用数组的包含/重叠条件过滤，
+    不需要join多对多关系。
+    """
+    field_class = forms.CharField
+
+    def __init__(self, related_model=None, related_field='name', **kwargs):
+        super().__init__(**kwargs)
+        self.related_model = related_model
+        self.related_field = related_field
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+        if isinstance(value, str):
+            array = value.split(' ')
+        elif isinstance(value, list):
+            array = value
+        else:
+            array = []
+        if len(array) <= 0:
+            return qs
+        keys = list(OrderedDict.fromkeys(array))
+        lookup = '%s__%s' % (self.related_field, self.lookup_expr)
+        id_groups = []
+        for key in keys:
+            id_list = list(self.related_model.objects.filter(**{lookup: key}).values_list('id', flat=True))
+            if len(id_list) <= 0:
+                # 有一项找不到任何匹配时，整个匹配为空
+                return qs.none()
+            id_groups.append(id_list)
+        # 只对应一个id的项合并成一个包含条件；对应多个id的项各自要求与数组有重叠
+        contains = sorted(set(group[0] for group in id_groups if len(group) == 1))
+        q = Q(**{'%s__contains' % (self.field_name,): contains}) if len(contains) > 0 else Q()
+        for group in id_groups:
+            if len(group) > 1:
+                q &= Q(**{'%s__overlap' % (self.field_name,): group})
+        return self.get_method(qs)(q)
+
+
+class AnimationSearchFilter(rest_filters.SearchFilter):
+    """
+    基于animation的搜索文档的搜索。
+    每个搜索词都要出现在搜索文档中(由pg_trgm的GIN索引支持)，不再需要多表join和distinct。
+    没有指定ordering时，结果按全文检索的rank与标题的三元组相似度排序。
+    """
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        for term in terms:
+            queryset = queryset.filter(search_document__icontains=term)
+        text = ' '.join(terms)
+        rank = SearchRank(F('search_vector'), SearchQuery(text, config='simple')) + TrigramSimilarity('title', text)
+        return queryset.annotate(search_rank=rank).order_by('-search_rank', '-id')
+
+
 class Database:
     class Animation(django_filters.FilterSet):
         original_work_type = django_filters.CharFilter(lookup_expr='iexact')
@@ -63,10 +138,11 @@ class Database:
         publish_time__ge = django_filters.DateFilter(field_name='publish_time', lookup_expr='gte')
         publish_time__le = django_filters.DateFilter(field_name='publish_time', lookup_expr='lte')
         limit_level = django_filters.CharFilter(lookup_expr='iexact')
-        tags__name = EachSearchFilter(field_name='tags__name', lookup_expr='iexact')
-        original_work_authors = django_filters.NumberFilter(field_name='original_work_authors__id', lookup_expr='exact')
-        staff_companies = django_filters.NumberFilter(field_name='staff_companies__id', lookup_expr='exact')
-        staff_supervisors = django_filters.NumberFilter(field_name='staff_supervisors__id', lookup_expr='exact')
+        tags__name = EachArrayFilter(field_name='tag_ids', related_model=app_models.Tag, related_field='name',
+                                     lookup_expr='iexact')
+        original_work_authors = ArrayContainFilter(field_name='original_work_author_ids')
+        staff_companies = ArrayContainFilter(field_name='staff_company_ids')
+        staff_supervisors = ArrayContainFilter(field_name='staff_supervisor_ids')
 
         class Meta:
             model = app_models.Animation
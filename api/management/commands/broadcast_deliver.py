@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from api import services
+
+
+class Command(BaseCommand):
+    help = 'Continue delivering all unfinished broadcasts.'
+
+    def handle(self, *args, **kwargs):
+        for broadcast in services.Broadcast.unfinished():
+            if services.Broadcast.deliver(broadcast.id):
+                self.stdout.write('Broadcast %s delivered.' % (broadcast.id,))
+            else:
+                self.stdout.write('Broadcast %s is being delivered by another worker, skipped.' % (broadcast.id,))
+        self.stdout.write('Finished.')
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from api import models as app_models, covers as app_covers
+from api.storage import get_storage
+
+# 由封面上传生成的文件名前缀，其他文件不会被清理
+COVER_PREFIXES = ('animation-', 'profile-')
+
+
+def referenced_names():
+    """
+    :return: 数据库中仍在使用的全部文件名，包括处理中的封面和各个变体。
+    """
+    names = set()
+    for model in (app_models.Animation, app_models.Profile):
+        for cover, cover_pending in model.objects.values_list('cover', 'cover_pending'):
+            for name in (cover, cover_pending):
+                if name:
+                    names.add(name)
+                    names.update(app_covers.variant_name(name, size, fmt) for size, fmt in app_covers.variants())
+    return names
+
+
+class Command(BaseCommand):
+    help = 'Delete cover files in the storage that are no longer referenced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the files that would be deleted.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **kwargs):
+        storage = get_storage()
+        # 先列出存储中的文件再查询引用，列出之后才上传的封面不会被误删
+        stored = [name for name in storage.names() if name.startswith(COVER_PREFIXES)]
+        referenced = referenced_names()
+        orphans = [name for name in stored if name not in referenced]
+        if kwargs['dry_run']:
+            for name in orphans:
+                self.stdout.write(name)
+            self.stdout.write('%s of %s files would be deleted.' % (len(orphans), len(stored)))
+            return
+
+        batch_size = kwargs['batch_size']
+        for i in range(0, len(orphans), batch_size):
+            storage.batch_delete(orphans[i:i + batch_size])
+        app_covers.exists.cache_clear()
+        self.stdout.write('%s of %s files was deleted.' % (len(orphans), len(stored)))
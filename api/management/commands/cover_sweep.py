@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from api import covers as app_covers
+
+
+class Command(BaseCommand):
+    help = 'Clear cover uploads whose processing was lost, and their stashed files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=60 * 60,
+                            help='Seconds after which a pending cover is considered lost.')
+
+    def handle(self, *args, **kwargs):
+        pending_count, stash_count = app_covers.sweep(kwargs['max_age'])
+        self.stdout.write('%s pending cover was cleared, %s stashed file was removed.' % (pending_count, stash_count))
@@ -1,18 +1,130 @@
 from django.core.management.base import BaseCommand
-from AnimationBoard.settings import COVER_DIRS
-from api.oss import bucket
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from AnimationBoard.settings import BASE_DIR, COVER_DIRS
+from api.storage import OssStorage
+import hashlib
 import os
+import threading
+import time
+
+
+class Manifest(object):
+    """
+    已经上传完成的文件清单，每行一个"<文件名>\t<大小>\t<mtime>"。
+    中断后再次执行时，清单中大小与mtime都没有变化的文件直接跳过。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) == 3:
+                        self.done[parts[0]] = (int(parts[1]), parts[2])
+        self.file = open(path, 'a')
+
+    def contains(self, name, size, mtime):
+        return self.done.get(name) == (size, mtime)
+
+    def add(self, name, size, mtime):
+        with self.lock:
+            self.done[name] = (size, mtime)
+            self.file.write('%s\t%s\t%s\n' % (name, size, mtime))
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def upload(storage, name, path, size, checksum=False, retries=3, backoff=1.0):
+    """
+    上传一个文件。存储中已经存在大小相同(指定checksum时还要求MD5相同)的文件时跳过。
+    :return: 是否实际上传了。
+    """
+    attempt = 0
+    while True:
+        try:
+            meta = storage.head(name)
+            if meta is not None and meta[0] == size and (not checksum or meta[1] == file_md5(path)):
+                return False
+            storage.put_file(name, path)
+            return True
+        except storage.TRANSIENT_ERRORS:
+            attempt += 1
+            if attempt > retries:
+                raise
+            time.sleep(backoff * 2 ** (attempt - 1))
 
 
 class Command(BaseCommand):
     help = 'Transform all local fs cover to oss.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Number of concurrent uploads.')
+        parser.add_argument('--manifest', default=os.path.join(BASE_DIR, 'fs2oss.manifest'),
+                            help='Checkpoint file of finished uploads.')
+        parser.add_argument('--checksum', action='store_true', help='Compare MD5 besides size for existing objects.')
+        parser.add_argument('--retries', type=int, default=3)
+        parser.add_argument('--endpoint', default=None, help='Override the oss endpoint, e.g. a local stand-in.')
+        parser.add_argument('--bucket', default=None, help='Override the bucket name.')
+
+    @staticmethod
+    def get_storage(endpoint=None, bucket_name=None):
+        return OssStorage(endpoint, bucket_name)
+
     def handle(self, *args, **kwargs):
-        cnt = 0
-        for parent, _, filenames in os.walk(COVER_DIRS):
-            for filename in filenames:
-                file_path = os.path.join(parent, filename)
-                bucket.put_object_from_file(filename, file_path)
-                cnt += 1
-                print('[%s] uploaded.' % (filename,))
-        print('%s image was uploaded.' % (cnt,))
+        target = self.get_storage(kwargs['endpoint'], kwargs['bucket'])
+        manifest = Manifest(kwargs['manifest'])
+        uploaded, skipped, failed, uploaded_bytes = 0, 0, 0, 0
+        try:
+            files = []
+            in_manifest = 0
+            for parent, _, filenames in os.walk(COVER_DIRS):
+                for filename in filenames:
+                    file_path = os.path.join(parent, filename)
+                    stat = os.stat(file_path)
+                    mtime = str(int(stat.st_mtime))
+                    if manifest.contains(filename, stat.st_size, mtime):
+                        in_manifest += 1
+                    else:
+                        files.append((filename, file_path, stat.st_size, mtime))
+            self.stdout.write('%s files to upload, %s already in manifest.' % (len(files), in_manifest))
+            # 进度与速率只统计本次提交的文件，清单中跳过的不计入
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=kwargs['workers']) as executor:
+                futures = {executor.submit(upload, target, name, path, size, kwargs['checksum'], kwargs['retries']):
+                           (name, size, mtime) for name, path, size, mtime in files}
+                for future in as_completed(futures):
+                    name, size, mtime = futures[future]
+                    try:
+                        if future.result():
+                            uploaded += 1
+                            uploaded_bytes += size
+                        else:
+                            skipped += 1
+                        manifest.add(name, size, mtime)
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write('[%s] failed: %s' % (name, e))
+                    done = uploaded + skipped + failed
+                    if done % 1000 == 0:
+                        elapsed = max(time.time() - start, 0.001)
+                        self.stdout.write('%s/%s files processed, %.1f files/s, about %.0f seconds left.' % (
+                            done, len(files), done / elapsed, (len(files) - done) * elapsed / done))
+        finally:
+            manifest.close()
+        elapsed = max(time.time() - start, 0.001)
+        self.stdout.write('%s image was uploaded, %s skipped, %s failed, %s already in manifest.' % (
+            uploaded, skipped, failed, in_manifest))
+        self.stdout.write('%.1f seconds, %.1f files/s, %.2f MB/s.' % (
+            elapsed, (uploaded + skipped + failed) / elapsed, uploaded_bytes / elapsed / 1024 / 1024))
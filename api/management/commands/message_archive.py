@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from AnimationBoard.settings import MESSAGE_ARCHIVE_SETTINGS
+from api import services
+
+
+class Command(BaseCommand):
+    help = 'Archive read messages older than the retention days.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=MESSAGE_ARCHIVE_SETTINGS['days'])
+        parser.add_argument('--batch-size', type=int, default=MESSAGE_ARCHIVE_SETTINGS['batch_size'])
+
+    def handle(self, *args, **kwargs):
+        count = 0
+        for batch in services.Message.archive(kwargs['days'], kwargs['batch_size']):
+            count += batch
+            self.stdout.write('Archived %s message(s)...' % (count,))
+        self.stdout.write('Successfully archived %s message(s).' % (count,))
@@ -1,30 +1,96 @@
 from django.core.management.base import BaseCommand
-from api import models as app_models, relations as app_relations
-from AnimationBoard.settings import COVER_DIRS
+from django.db import connection, transaction
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from api import models as app_models
+from api.storage import get_storage
 from PIL import Image
+import io
 import os
 
+# 将所有animation的relations中，id在映射中的缓存对象的cover替换为新的文件名
+UPDATE_RELATION_COVER_SQL = """
+    update api_animation a set relations = (
+      select jsonb_object_agg(r.key, case when jsonb_typeof(r.value) <> 'array' then r.value else (
+        select coalesce(jsonb_agg(case when m.cover is null then t.e
+                                       else jsonb_set(t.e, '{cover}', to_jsonb(m.cover)) end
+                                  order by t.ord), '[]'::jsonb)
+        from jsonb_array_elements(r.value) with ordinality as t(e, ord)
+        left join unnest(%s::text[], %s::text[]) as m(id, cover)
+          on jsonb_typeof(t.e) = 'object' and t.e->>'id' = m.id
+      ) end)
+      from jsonb_each(a.relations) r
+    )
+    where a.id in (
+      select a2.id from api_animation a2, jsonb_each(a2.relations) r2
+      where jsonb_typeof(r2.value) = 'array' and exists (
+        select 1 from jsonb_array_elements(r2.value) e
+        where jsonb_typeof(e) = 'object' and e->>'id' = any(%s::text[])
+      )
+    )
+"""
+
+
+def convert(old_name, new_name):
+    """
+    在工作进程中执行：将存储中的png转换为jpeg。
+    :return: 原文件不存在时返回False。
+    """
+    data = get_storage().get(old_name)
+    if data is None:
+        return False
+    output = io.BytesIO()
+    Image.open(io.BytesIO(data)).convert('RGB').save(output, format='JPEG')
+    get_storage().put(new_name, output.getvalue())
+    return True
+
 
 class Command(BaseCommand):
     help = 'Translate all png image to jpeg image.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of processes converting images.')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the covers that would be converted.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
     def handle(self, *args, **kwargs):
-        cnt = 0
-        for animation in app_models.Animation.objects.all():
-            if animation.cover is not None and animation.cover.endswith('.png'):
-                old_cover_name = animation.cover
+        animations = list(app_models.Animation.objects.filter(cover__endswith='.png').only('id', 'cover'))
+        if kwargs['dry_run']:
+            for animation in animations:
+                self.stdout.write('[%s] %s' % (animation.id, animation.cover))
+            self.stdout.write('%s image would be updated.' % (len(animations),))
+            return
+
+        converted = []      # [(animation, 原文件是否存在)]
+        failed = 0
+        # 存储只存在于本进程中(memory)时，工作进程写入的内容本进程看不到，改为在线程中转换
+        pool = ProcessPoolExecutor if get_storage().SHARED else ThreadPoolExecutor
+        with pool(max_workers=kwargs['workers']) as executor:
+            futures = []
+            for animation in animations:
                 new_cover_name = animation.cover[:len(animation.cover) - 4] + '.jpg'
+                futures.append((animation, new_cover_name,
+                                executor.submit(convert, animation.cover, new_cover_name)))
+            for animation, new_cover_name, future in futures:
+                try:
+                    existed = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write('[%s] %s failed: %s' % (animation.id, animation.cover, e))
+                    continue
+                converted.append((animation, animation.cover, existed))
                 animation.cover = new_cover_name
-                animation.save()
-                updated = set()
-                app_relations.spread_cache_field(animation.id, animation.relations,
-                                                 lambda id_list: app_models.Animation.objects.filter(id__in=id_list).
-                                                 all(), 'cover', new_cover_name,
-                                                 lambda i: updated.add(i))
-                for item in updated:
-                    item.save()
-                if os.path.exists(COVER_DIRS + '/' + old_cover_name):
-                    Image.open(COVER_DIRS + '/' + old_cover_name).convert('RGB').save(COVER_DIRS + '/' + new_cover_name)
-                    os.remove(COVER_DIRS + '/' + old_cover_name)
-                cnt += 1
-        print('%s image was updated.' % (cnt,))
+
+        if len(converted) > 0:
+            updated = [animation for animation, _, _ in converted]
+            with transaction.atomic():
+                app_models.Animation.objects.bulk_update(updated, ['cover'], batch_size=kwargs['batch_size'])
+                with connection.cursor() as cursor:
+                    id_list = [str(animation.id) for animation in updated]
+                    cursor.execute(UPDATE_RELATION_COVER_SQL,
+                                   [id_list, [animation.cover for animation in updated], id_list])
+                    relation_count = cursor.rowcount
+            self.stdout.write('%s relation cache was updated.' % (relation_count,))
+            # 数据库已经指向新文件之后再删除旧文件
+            get_storage().batch_delete([old_cover_name for _, old_cover_name, existed in converted if existed])
+        self.stdout.write('%s image was updated, %s failed.' % (len(converted), failed))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from api import services
+
+
+class Command(BaseCommand):
+    help = 'Recount unread messages of all profiles.'
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write('Repair %s profile(s).' % (services.Message.recount_unread(),))
+        self.stdout.write('Successfully recounted unread messages.')
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='unread_message_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            sql="""
+                update api_profile p set unread_message_count = (
+                  select count(*) from api_message am where am.owner_id = p.id and not am.read
+                )
+            """,
+            reverse_sql=migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_profile_unread_message_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(read=False), fields=['owner', 'id'], name='api_message_unread_idx'),
+        ),
+    ]
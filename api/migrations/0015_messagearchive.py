@@ -0,0 +1,39 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:24
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_message_unread_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('type', models.CharField(choices=[('SYS', 'System'), ('CHAT', 'Chat'), ('UPDATE', 'Update')], max_length=8)),
+                ('content', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('create_time', models.DateTimeField()),
+                ('archive_time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(read=True), fields=['create_time'], name='api_message_read_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='messagearchive',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages_by_owner', to='api.Profile'),
+        ),
+        migrations.AddField(
+            model_name='messagearchive',
+            name='sender',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages_by_sender', to='api.Profile'),
+        ),
+    ]
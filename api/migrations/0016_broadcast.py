@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_messagearchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('staff_only', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=8)),
+                ('total', models.IntegerField(default=0)),
+                ('delivered', models.IntegerField(default=0)),
+                ('cursor', models.BigIntegerField(default=0)),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('creator', models.CharField(max_length=64)),
+                ('finish_time', models.DateTimeField(default=None, null=True)),
+            ],
+        ),
+    ]
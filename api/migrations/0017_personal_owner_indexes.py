@@ -0,0 +1,37 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['owner', 'score'], name='api_comment_owner_score_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['owner', 'update_time'], name='api_comment_owner_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diary',
+            index=models.Index(fields=['owner', 'status'], name='api_diary_owner_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diary',
+            index=models.Index(fields=['owner', 'create_time'], name='api_diary_owner_create_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diary',
+            index=models.Index(fields=['owner', 'update_time'], name='api_diary_owner_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diary',
+            index=models.Index(fields=['owner', 'finish_time'], name='api_diary_owner_finish_idx'),
+        ),
+    ]
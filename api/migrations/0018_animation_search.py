@@ -0,0 +1,57 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:29
+
+from django.contrib.postgres.operations import TrigramExtension
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+FILL_SEARCH_DOCUMENT = """
+    update api_animation a set search_document = d.document, search_vector = to_tsvector('simple', d.document)
+    from (
+      select aa.id, concat_ws(' ', aa.title, aa.origin_title, aa.other_title, aa.keyword,
+        (select string_agg(t.name, ' ')
+         from api_animation_tags aat inner join api_tag t on t.id = aat.tag_id
+         where aat.animation_id = aa.id),
+        (select string_agg(s.name, ' ')
+         from api_staff s
+         where s.id in (select staff_id from api_animation_original_work_authors where animation_id = aa.id
+                        union select staff_id from api_animation_staff_companies where animation_id = aa.id
+                        union select staff_id from api_animation_staff_supervisors where animation_id = aa.id))
+      ) as document
+      from api_animation aa
+    ) d
+    where a.id = d.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_personal_owner_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='animation',
+            name='search_document',
+            field=models.TextField(default=''),
+        ),
+        migrations.AddField(
+            model_name='animation',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.RunSQL(sql=FILL_SEARCH_DOCUMENT, reverse_sql=migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='animation',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='api_animation_search_idx'),
+        ),
+        # icontains生成的条件是upper(search_document::text) like upper(...)，因此建立在upper表达式上
+        migrations.RunSQL(
+            sql='create index api_animation_search_trgm_idx on api_animation '
+                'using gin (upper(search_document) gin_trgm_ops)',
+            reverse_sql='drop index api_animation_search_trgm_idx'
+        ),
+    ]
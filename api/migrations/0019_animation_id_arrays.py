@@ -0,0 +1,65 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:33
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+FILL_ID_ARRAYS = """
+    update api_animation aa set
+      tag_ids = array(select tag_id from api_animation_tags
+                      where animation_id = aa.id order by tag_id),
+      original_work_author_ids = array(select staff_id from api_animation_original_work_authors
+                                       where animation_id = aa.id order by staff_id),
+      staff_company_ids = array(select staff_id from api_animation_staff_companies
+                                where animation_id = aa.id order by staff_id),
+      staff_supervisor_ids = array(select staff_id from api_animation_staff_supervisors
+                                   where animation_id = aa.id order by staff_id)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_animation_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='animation',
+            name='original_work_author_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='animation',
+            name='staff_company_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='animation',
+            name='staff_supervisor_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='animation',
+            name='tag_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), default=list, size=None),
+        ),
+        migrations.RunSQL(sql=FILL_ID_ARRAYS, reverse_sql=migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='animation',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tag_ids'], name='api_animation_tags_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='animation',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['original_work_author_ids'], name='api_animation_authors_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='animation',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['staff_company_ids'], name='api_animation_companies_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='animation',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['staff_supervisor_ids'], name='api_animation_supervisors_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_animation_id_arrays'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='animation',
+            name='cover_pending',
+            field=models.CharField(default=None, max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='cover_pending',
+            field=models.CharField(default=None, max_length=256, null=True),
+        ),
+    ]
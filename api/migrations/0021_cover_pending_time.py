@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-19 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_cover_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='animation',
+            name='cover_pending_time',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='cover_pending_time',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
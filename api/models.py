@@ -1,6 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField, ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from . import enums
 from django.utils import timezone
 
@@ -10,9 +12,12 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=32)
     cover = models.CharField(max_length=256, null=True, default=None)
+    cover_pending = models.CharField(max_length=256, null=True, default=None)  # 正在后台处理的新封面
+    cover_pending_time = models.DateTimeField(null=True, default=None)         # 开始处理新封面的时间
 
     animation_update_notice = models.BooleanField(null=False, default=True)     # 订阅的动画更新时，会发送消息提示
     night_update_mode = models.BooleanField(null=False, default=False)          # 使用深夜动画表(26:00模式)
+    unread_message_count = models.IntegerField(null=False, default=0)           # 未读消息数量的冗余计数
 
     enable = models.BooleanField(null=False, default=True)
     create_path = models.CharField(max_length=8, null=False, blank=False, choices=enums.PROFILE_CREATE_PATH_CHOICE)
@@ -59,6 +64,46 @@ class Message(models.Model):
     read = models.BooleanField(null=False, default=False)
     create_time = models.DateTimeField(null=False, auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'id'], name='api_message_unread_idx', condition=models.Q(read=False)),
+            models.Index(fields=['create_time'], name='api_message_read_time_idx', condition=models.Q(read=True))
+        ]
+
+
+class MessageArchive(models.Model):
+    """
+    已归档的message。超过保留期限的已读message会从Message表移动到这里，不再参与列表查询。
+    id沿用原message的id。
+    """
+    id = models.BigIntegerField(primary_key=True, null=False)
+    owner = models.ForeignKey(Profile, on_delete=models.CASCADE, null=False, related_name='archived_messages_by_owner')
+    sender = models.ForeignKey(Profile, on_delete=models.CASCADE, null=True, related_name='archived_messages_by_sender')
+    type = models.CharField(choices=enums.MESSAGE_TYPE_CHOICE, null=False, max_length=8)
+    content = JSONField(null=False)
+    create_time = models.DateTimeField(null=False)
+    archive_time = models.DateTimeField(null=False, auto_now_add=True)
+
+
+class Broadcast(models.Model):
+    """
+    向一组profile群发的系统通知。投递在后台按profile id分批进行，
+    cursor记录已投递到的最后一个profile id，delivered记录已投递的数量。
+    """
+    id = models.BigAutoField(primary_key=True, null=False)
+    content = models.TextField(null=False)
+    staff_only = models.BooleanField(null=False, default=False)
+
+    status = models.CharField(choices=enums.BROADCAST_STATUS_CHOICE, max_length=8, null=False,
+                              default=enums.BroadcastStatus.pending)
+    total = models.IntegerField(null=False, default=0)
+    delivered = models.IntegerField(null=False, default=0)
+    cursor = models.BigIntegerField(null=False, default=0)
+
+    create_time = models.DateTimeField(null=False, auto_now_add=True)
+    creator = models.CharField(max_length=64, null=False)
+    finish_time = models.DateTimeField(null=True, default=None)
+
 
 class RegistrationCode(models.Model):
     id = models.BigAutoField(primary_key=True, null=False)
@@ -73,6 +118,8 @@ class RegistrationCode(models.Model):
 class Animation(models.Model):
     id = models.BigAutoField(primary_key=True, null=False)
     cover = models.CharField(max_length=256, null=True, default=None)
+    cover_pending = models.CharField(max_length=256, null=True, default=None)  # 正在后台处理的新封面
+    cover_pending_time = models.DateTimeField(null=True, default=None)         # 开始处理新封面的时间
     title = models.CharField(max_length=64, null=False, blank=False)
     origin_title = models.CharField(max_length=64, null=True)
     other_title = models.CharField(max_length=64, null=True)
@@ -105,11 +152,43 @@ class Animation(models.Model):
     update_time = models.DateTimeField(null=True, auto_now=True)
     updater = models.CharField(max_length=64, null=True)
 
+    # 以下均为派生字段，通过services.Animation.refresh_derived维护
+    # 搜索文档。由标题、关键字、标签名和staff名拼接而成
+    # search_document上另有upper(search_document)的pg_trgm表达式索引(见migration)，用于icontains
+    search_document = models.TextField(null=False, default='')
+    search_vector = SearchVectorField(null=True)
+    # 多对多关系的id数组，使筛选可以在单表上用GIN索引完成
+    tag_ids = ArrayField(models.BigIntegerField(null=False), null=False, default=list)
+    original_work_author_ids = ArrayField(models.BigIntegerField(null=False), null=False, default=list)
+    staff_company_ids = ArrayField(models.BigIntegerField(null=False), null=False, default=list)
+    staff_supervisor_ids = ArrayField(models.BigIntegerField(null=False), null=False, default=list)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='api_animation_search_idx'),
+            GinIndex(fields=['tag_ids'], name='api_animation_tags_idx'),
+            GinIndex(fields=['original_work_author_ids'], name='api_animation_authors_idx'),
+            GinIndex(fields=['staff_company_ids'], name='api_animation_companies_idx'),
+            GinIndex(fields=['staff_supervisor_ids'], name='api_animation_supervisors_idx')
+        ]
+
     def __str__(self):
         return "<[%s]%s>" % (self.id, self.title)
 
+    STAFF_FIELDS = ('original_work_authors', 'staff_companies', 'staff_supervisors')
+    DERIVED_FIELDS = ('search_document', 'search_vector', 'tag_ids',
+                      'original_work_author_ids', 'staff_company_ids', 'staff_supervisor_ids')
+
     @property
     def all_staffs(self):
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if all(field in prefetched for field in self.STAFF_FIELDS):
+            # 三个staff关系都已经预取时，直接从缓存合并去重，不再发起union查询
+            staffs = {}
+            for field in self.STAFF_FIELDS:
+                for staff in getattr(self, field).all():
+                    staffs[staff.id] = staff
+            return [staffs[i] for i in sorted(staffs.keys())]
         return self.original_work_authors.all() | self.staff_companies.all() | self.staff_supervisors.all()
 
     def take_published_count(self):
@@ -181,6 +260,14 @@ class Diary(models.Model):
     create_time = models.DateTimeField(null=False, auto_now_add=True)
     update_time = models.DateTimeField(null=True, auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'status'], name='api_diary_owner_status_idx'),
+            models.Index(fields=['owner', 'create_time'], name='api_diary_owner_create_idx'),
+            models.Index(fields=['owner', 'update_time'], name='api_diary_owner_update_idx'),
+            models.Index(fields=['owner', 'finish_time'], name='api_diary_owner_finish_idx')
+        ]
+
 
 class Comment(models.Model):
     id = models.BigAutoField(primary_key=True, null=False)
@@ -196,6 +283,12 @@ class Comment(models.Model):
 
     title = models.CharField(max_length=64, null=False, blank=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'score'], name='api_comment_owner_score_idx'),
+            models.Index(fields=['owner', 'update_time'], name='api_comment_owner_update_idx')
+        ]
+
 
 class Statistics(models.Model):
     id = models.BigAutoField(primary_key=True, null=False)
@@ -0,0 +1,180 @@
+"""
+基于PostgreSQL LISTEN/NOTIFY的进程内通知分发。
+每个进程只持有一条专用的监听连接，由一个后台线程接收全部通知，再分发给订阅者。
+等待通知的请求不会各自占用数据库连接。
+"""
+from django.conf import settings
+from django.db import connection
+import psycopg2
+import select
+import threading
+import time
+
+CHANNEL_MESSAGE = 'api_message'
+CHANNEL_DATABASE = 'api_database'
+
+
+def send(channel, payloads):
+    """
+    在当前的数据库连接上发送一组通知。处于事务中时，通知会在事务提交后才被投递。
+    :param channel:
+    :param payloads: str的序列。
+    :return:
+    """
+    payloads = list(payloads)
+    if len(payloads) <= 0:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            select pg_notify(%s, payload) from unnest(%s::text[]) as payload
+        """, [channel, payloads])
+
+
+class Listener(object):
+    POLL_INTERVAL = 5           # seconds
+    RECONNECT_INTERVAL = 3      # seconds
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.callbacks = {}     # channel -> [(on_notify, on_reset)]
+        self.conn = None
+        self.thread = None
+
+    def subscribe(self, channel, on_notify, on_reset=None):
+        """
+        订阅一个频道。on_notify(payload)在监听线程中被调用；
+        监听连接断开重连后，可能遗漏了部分通知，此时调用on_reset()。
+        第一次订阅时会启动监听线程。
+        """
+        with self.lock:
+            new_channel = channel not in self.callbacks
+            callbacks = self.callbacks.setdefault(channel, [])
+            callbacks.append((on_notify, on_reset))
+            if self.thread is None:
+                try:
+                    self.connect()
+                except psycopg2.Error:
+                    callbacks.pop()
+                    if len(callbacks) <= 0:
+                        del self.callbacks[channel]
+                    self.close()
+                    raise
+                self.thread = threading.Thread(target=self.run, name='api-notify-listener', daemon=True)
+                self.thread.start()
+            elif new_channel and self.conn is not None:
+                try:
+                    self.listen(channel)
+                except psycopg2.Error:
+                    # 交给监听线程重连，重连后会重新listen全部频道
+                    self.close()
+
+    def connect(self):
+        db = settings.DATABASES['default']
+        conn = psycopg2.connect(dbname=db['NAME'], user=db['USER'], password=db['PASSWORD'],
+                                host=db['HOST'], port=db['PORT'])
+        conn.autocommit = True
+        self.conn = conn
+        for channel in self.callbacks.keys():
+            self.listen(channel)
+
+    def listen(self, channel):
+        with self.conn.cursor() as cursor:
+            cursor.execute('listen "%s"' % (channel,))
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
+    def run(self):
+        while True:
+            try:
+                with self.lock:
+                    reconnected = self.conn is None
+                    if reconnected:
+                        self.connect()
+                    conn = self.conn
+                if reconnected:
+                    self.dispatch_reset()
+                if select.select([conn], [], [], self.POLL_INTERVAL) == ([], [], []):
+                    continue
+                with self.lock:
+                    if conn is not self.conn:
+                        continue
+                    conn.poll()
+                    notifies = list(conn.notifies)
+                    del conn.notifies[:]
+                for n in notifies:
+                    self.dispatch(n.channel, n.payload)
+            except (psycopg2.Error, OSError, ValueError):
+                with self.lock:
+                    self.close()
+                time.sleep(self.RECONNECT_INTERVAL)
+
+    def dispatch(self, channel, payload):
+        for on_notify, _ in list(self.callbacks.get(channel, [])):
+            try:
+                on_notify(payload)
+            except Exception:
+                pass
+
+    def dispatch_reset(self):
+        for callbacks in list(self.callbacks.values()):
+            for _, on_reset in callbacks:
+                if on_reset is not None:
+                    try:
+                        on_reset()
+                    except Exception:
+                        pass
+
+
+class Mailbox(object):
+    """
+    按owner记录已通知的最新message id，供长轮询的请求等待新消息。
+    通知的payload格式为"<owner_id>:<message_id>"。
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.latest = {}
+
+    def put(self, payload):
+        owner_id, message_id = (int(i) for i in payload.split(':'))
+        with self.condition:
+            if message_id > self.latest.get(owner_id, 0):
+                self.latest[owner_id] = message_id
+                self.condition.notify_all()
+
+    def wait(self, owner_id, since, timeout):
+        """
+        阻塞直到owner有id大于since的新消息，或者超时。
+        :return: 是否有新消息。
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.latest.get(owner_id, 0) > since, timeout)
+
+
+listener = Listener()
+mailbox = None
+mailbox_lock = threading.Lock()
+
+
+def message_payload(message):
+    return '%s:%s' % (message.owner_id, message.id)
+
+
+def database_payload(kind, obj_id):
+    return '%s:%s' % (kind, obj_id)
+
+
+def get_mailbox():
+    """获得本进程的mailbox。第一次调用时开始监听message频道。"""
+    global mailbox
+    with mailbox_lock:
+        if mailbox is None:
+            box = Mailbox()
+            listener.subscribe(CHANNEL_MESSAGE, box.put)
+            mailbox = box
+    return mailbox
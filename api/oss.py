@@ -1,28 +1,93 @@
-import oss2
+from collections import OrderedDict
+import threading
 import config
 import time
 
-if config.COVER_STORAGE['TYPE'] == 'oss':
-    auth = oss2.Auth(config.COVER_STORAGE['OSS']['access_key_id'], config.COVER_STORAGE['OSS']['access_key_secret'])
-    bucket = oss2.Bucket(auth, config.COVER_STORAGE['OSS']['endpoint'], config.COVER_STORAGE['OSS']['bucket_name'])
-else:
-    bucket = None
+SIGN_CACHE = config.COVER_STORAGE.get('OSS', {}).get('sign_cache', {})
 
 
-sign_url_cache = dict()
-sign_timeout_cache = dict()
+class SignCache(object):
+    """
+    签名URL的缓存。
+    本进程内是一个有数量上限的LRU；剩余有效期不足refresh_margin的签名视为过期，在真正过期之前就会重新签名。
+    可以指定一个Django cache作为共享后端(例如文件或/dev/shm上的FileBasedCache、memcached)，
+    使同一节点上的所有worker复用签名：本进程未命中时先查共享后端，新的签名同时写入两者。
+    """
+    def __init__(self, max_size, refresh_margin, backend=None):
+        self.max_size = max_size
+        self.refresh_margin = refresh_margin
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.data = OrderedDict()   # file_name -> (url, expire)
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get_backend(self):
+        if self.backend is None:
+            return None
+        from django.core.cache import caches
+        return caches[self.backend]
+
+    def get(self, file_name, sign):
+        """
+        :param file_name:
+        :param sign: 未命中时调用sign(file_name)，返回(url, 过期的时间戳)。
+        :return: (url, 过期的时间戳)
+        """
+        now = time.time()
+        with self.lock:
+            item = self.data.get(file_name)
+            if item is not None:
+                if item[1] - now > self.refresh_margin:
+                    self.data.move_to_end(file_name)
+                    self.hits += 1
+                    return item
+                del self.data[file_name]
+        backend = self.get_backend()
+        item = backend.get('oss-sign:%s' % (file_name,)) if backend is not None else None
+        if item is not None and item[1] - now > self.refresh_margin:
+            with self.lock:
+                self.shared_hits += 1
+        else:
+            item = sign(file_name)
+            if backend is not None:
+                backend.set('oss-sign:%s' % (file_name,), item, max(1, int(item[1] - now - self.refresh_margin)))
+            with self.lock:
+                self.misses += 1
+        with self.lock:
+            self.data[file_name] = item
+            self.data.move_to_end(file_name)
+            self.evict()
+        return item
+
+    def evict(self):
+        # 按LRU淘汰；需要刷新的签名在下一次get时才会被替换，不在这里扫描
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses
+            }
+
+
+sign_cache = SignCache(SIGN_CACHE.get('max_size', 10000),
+                       SIGN_CACHE.get('refresh_margin', config.COVER_STORAGE.get('OSS', {}).get('sign_timeout', 0) // 4),
+                       SIGN_CACHE.get('backend'))
+
+
+def sign_url_with_expire(file_name):
+    """
+    :return: (url, 签名过期的时间戳)
+    """
+    from api.storage import get_storage
+    return get_storage().sign(file_name)
 
 
 def sign_url(file_name):
-    now = time.time()
-    url = None
-    if file_name in sign_url_cache:
-        timeout = sign_timeout_cache.get(file_name)
-        if timeout > now:
-            url = sign_url_cache.get(file_name)
-    if url is None:
-        url = 'https' + bucket.sign_url('GET', file_name, config.COVER_STORAGE['OSS']['sign_timeout'])[4:]
-        timeout = now + config.COVER_STORAGE['OSS']['sign_timeout']
-        sign_timeout_cache[file_name] = timeout
-        sign_url_cache[file_name] = url
-    return url
+    return sign_url_with_expire(file_name)[0]
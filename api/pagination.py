@@ -0,0 +1,219 @@
+from rest_framework import pagination, response, exceptions
+from rest_framework.utils.urls import replace_query_param
+from django.db import connections
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+from collections import OrderedDict
+import base64
+import json
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    键集(游标)分页。
+    按(排序字段, id)定位下一页的起点，不使用OFFSET，也不计算总数，因此翻到多深的页面代价都相同。
+    排序字段取自ordering参数的第一项，必须在视图的cursor_ordering_fields中；
+    否则使用视图的默认ordering，仍不符合时使用-id。排序字段的null值总是排在最后。
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    ordering_query_param = 'ordering'
+    default_limit = 20
+    max_limit = 1000
+
+    def __init__(self):
+        self.request = None
+        self.next_position = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        limit = self.get_limit(request)
+        field, desc = self.get_ordering(request, view)
+        position = self.decode_cursor(request.query_params.get(self.cursor_query_param), field)
+
+        if field == 'id':
+            order = [F('id').desc() if desc else F('id').asc()]
+        else:
+            order = [F(field).desc(nulls_last=True) if desc else F(field).asc(nulls_last=True),
+                     F('id').desc() if desc else F('id').asc()]
+        queryset = queryset.order_by(*order)
+        if position is not None:
+            queryset = queryset.filter(self.position_filter(field, desc, *position))
+
+        results = list(queryset[:limit + 1])
+        if len(results) > limit:
+            results = results[:limit]
+            last = results[-1]
+            self.next_position = (field, getattr(last, field), last.id)
+        else:
+            self.next_position = None
+        return results
+
+    def get_paginated_response(self, data):
+        return response.Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(*self.next_position))
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+            if limit > 0:
+                return min(limit, self.max_limit)
+        except (KeyError, ValueError):
+            pass
+        return self.default_limit
+
+    def get_ordering(self, request, view):
+        """
+        :return: (排序字段, 是否倒序)
+        """
+        fields = getattr(view, 'cursor_ordering_fields', ('id',))
+        candidates = []
+        param = request.query_params.get(self.ordering_query_param)
+        if param:
+            candidates.append(param.split(',')[0].strip())
+        default = getattr(view, 'ordering', None)
+        if isinstance(default, str):
+            candidates.append(default)
+        elif default:
+            candidates.append(default[0])
+        for term in candidates:
+            if term.lstrip('-') in fields:
+                return term.lstrip('-'), term.startswith('-')
+        return 'id', True
+
+    @staticmethod
+    def position_filter(field, desc, value, index):
+        """
+        构造"排在(value, index)之后"的条件。null值排在最后。
+        """
+        if field == 'id':
+            return Q(id__lt=index) if desc else Q(id__gt=index)
+        cmp = 'lt' if desc else 'gt'
+        if value is None:
+            return Q(**{'%s__isnull' % (field,): True, 'id__%s' % (cmp,): index})
+        return Q(**{'%s__%s' % (field, cmp): value}) | \
+            Q(**{field: value, 'id__%s' % (cmp,): index}) | \
+            Q(**{'%s__isnull' % (field,): True})
+
+    @staticmethod
+    def encode_cursor(field, value, index):
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        data = json.dumps({'k': field, 'v': value, 'i': index}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor, field):
+        """
+        :return: (value, index)；cursor为空时返回None，表示第一页。
+        """
+        if not cursor:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            if data['k'] != field:
+                raise ValueError()
+            value, index = data['v'], int(data['i'])
+            if field == 'id':
+                return index, index
+            if value is not None:
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError()
+            return value, index
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise exceptions.NotFound('Invalid cursor.')
+
+
+class ListPagination(pagination.LimitOffsetPagination):
+    """
+    默认使用limit/offset分页；请求中带有cursor参数(第一页时可以为空)时改用键集分页。
+    视图的estimate_count为True且没有任何过滤条件时，count使用表的估计行数；有过滤条件、估计值低于阈值，
+    或者请求中带有count=exact参数时精确计数。响应中的count_estimated标明count是否为估计值。
+    """
+    count_query_param = 'count'
+    estimate_threshold = 1000
+
+    def __init__(self):
+        self.keyset = None
+        self.view = None
+        self.estimated = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if KeysetPagination.cursor_query_param in request.query_params:
+            # 键集分页没有count与offset，可浏览API中不显示页码控件
+            self.display_page_controls = False
+            self.keyset = KeysetPagination()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        self.request = request
+        self.view = view
+        self.count = self.get_count(queryset)
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+        if not self.estimated:
+            if self.count == 0 or self.offset > self.count:
+                return []
+            return list(queryset[self.offset:self.offset + self.limit])
+        # 估计值可能偏小，不能在offset超过count时直接返回空页，总是按offset取数据
+        results = list(queryset[self.offset:self.offset + self.limit])
+        # 用实际取到的行数修正估计值，使next链接在首尾处仍然准确
+        if len(results) < self.limit:
+            self.count = self.offset + len(results)
+        elif self.count <= self.offset + self.limit:
+            self.count = self.offset + self.limit + 1
+        return results
+
+    def get_count(self, queryset):
+        self.estimated = False
+        if getattr(self.view, 'estimate_count', False) and \
+                self.request.query_params.get(self.count_query_param) != 'exact':
+            count = estimate_count(queryset)
+            if count is not None and count >= self.estimate_threshold:
+                self.estimated = True
+                return count
+        return super().get_count(queryset)
+
+    def to_html(self):
+        if self.keyset is not None:
+            return ''
+        return super().to_html()
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return response.Response(OrderedDict([
+            ('count', self.count),
+            ('count_estimated', self.estimated),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+def estimate_count(queryset):
+    """
+    获得queryset行数的估计值。只估计没有过滤条件的queryset，直接读取pg_class.reltuples；
+    有过滤条件(包括搜索)时规划器的估计可能相差几个数量级，不做估计。
+    :return: 无法估计时返回None。
+    """
+    queryset = queryset.order_by()
+    if queryset.query.where or queryset.query.distinct:
+        return None
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute("""
+            select reltuples::bigint from pg_class where oid = %s::regclass
+        """, [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    return int(row[0]) if row is not None and row[0] >= 0 else None
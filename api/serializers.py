@@ -1,5 +1,6 @@
 from rest_framework import serializers, validators
 from . import models as app_models, enums, relations as app_relations, services, exceptions as app_exceptions
+from django.db import transaction
 from django.utils import timezone
 
 
@@ -44,6 +45,7 @@ class Profile:
     class Info(serializers.ModelSerializer):
         id = serializers.IntegerField(read_only=True)
         cover = serializers.CharField(read_only=True)
+        cover_pending = serializers.CharField(read_only=True)
         username = serializers.CharField(read_only=True)
         name = serializers.CharField(max_length=32, allow_null=False, allow_blank=False)
         create_time = serializers.DateTimeField(read_only=True)
@@ -59,7 +61,7 @@ class Profile:
 
         class Meta:
             model = app_models.Profile
-            fields = ('id', 'cover', 'username', 'name', 'create_time', 'last_login', 'last_ip',
+            fields = ('id', 'cover', 'cover_pending', 'username', 'name', 'create_time', 'last_login', 'last_ip',
                       'is_staff', 'is_superuser',
                       'animation_update_notice', 'night_update_mode')
 
@@ -92,11 +94,20 @@ class Profile:
             model = app_models.Message
             fields = ('id', 'read', 'type', 'content', 'create_time', 'sender', 'sender_name')
 
+    class MessageMarkRead(serializers.Serializer):
+        until = serializers.IntegerField(allow_null=True, required=False, default=None)
+        type = serializers.ChoiceField(choices=enums.MESSAGE_TYPE_CHOICE, allow_null=True, required=False,
+                                       default=None)
+
+        class Meta:
+            fields = ('until', 'type')
+
 
 class Database:
     class Animation(serializers.ModelSerializer):
         id = serializers.IntegerField(read_only=True)
         cover = serializers.CharField(read_only=True)
+        cover_pending = serializers.CharField(read_only=True)
         title = serializers.CharField(allow_null=False, allow_blank=False, max_length=64)
         origin_title = serializers.CharField(allow_null=True, max_length=64)
         other_title = serializers.CharField(allow_null=True, max_length=64)
@@ -134,12 +145,14 @@ class Database:
         update_time = serializers.DateTimeField(read_only=True)
         updater = serializers.CharField(read_only=True)
 
+        # simple模式(列表)下不输出的字段。列表查询也会据此defer这些列
+        SIMPLE_EXCLUDE = ('original_relations', 'links', 'relations', 'subtitle_list', 'published_record')
+
         def __init__(self, *args, **kwargs):
             simple = kwargs.pop('simple', False)
             super(Database.Animation, self).__init__(*args, **kwargs)
             if simple:
-                exclude = ['original_relations', 'links', 'relations', 'subtitle_list', 'published_record']
-                for field_name in exclude:
+                for field_name in self.SIMPLE_EXCLUDE:
                     self.fields.pop(field_name)
 
         def __new__(cls, *args, **kwargs):
@@ -220,7 +233,7 @@ class Database:
 
         class Meta:
             model = app_models.Animation
-            fields = ('id', 'cover', 'title', 'origin_title', 'other_title', 'staff_info',
+            fields = ('id', 'cover', 'cover_pending', 'title', 'origin_title', 'other_title', 'staff_info',
                       'original_work_type', 'original_work_authors', 'staff_companies', 'staff_supervisors',
                       'publish_type', 'publish_time', 'sum_quantity', 'published_quantity',
                       'duration', 'publish_plan', 'subtitle_list', 'published_record',
@@ -299,12 +312,16 @@ class Personal:
         create_time = serializers.DateTimeField(read_only=True)
         update_time = serializers.DateTimeField(read_only=True)
 
+        # simple模式(列表)下不输出的字段。列表查询也会据此defer这些列
+        SIMPLE_EXCLUDE = ('watched_record',)
+        # 经由animation输出的字段。查询时只join这些列
+        ANIMATION_FIELDS = ('title', 'cover', 'publish_plan', 'sum_quantity', 'published_quantity')
+
         def __init__(self, *args, **kwargs):
             simple = kwargs.pop('simple', False)
             super(Personal.Diary, self).__init__(*args, **kwargs)
             if simple:
-                exclude = ['watched_record']
-                for field_name in exclude:
+                for field_name in self.SIMPLE_EXCLUDE:
                     self.fields.pop(field_name)
 
         def __new__(cls, *args, **kwargs):
@@ -496,6 +513,9 @@ class Personal:
                       'status', 'watch_many_times', 'watch_original_work', 'create_time', 'update_time')
 
     class Comment(serializers.ModelSerializer):
+        # 经由animation输出的字段。查询时只join这些列
+        ANIMATION_FIELDS = ('title', 'cover')
+
         id = serializers.IntegerField(read_only=True)
         title = serializers.CharField(read_only=True, source='animation.title')
         cover = serializers.CharField(read_only=True, source='animation.cover')
@@ -609,8 +629,29 @@ class Admin:
         def create(self, validated_data):
             validated_data['type'] = enums.MessageType.system
             validated_data['content'] = {'content': validated_data.pop('system_message_content')}
-            return super().create(validated_data)
+            with transaction.atomic():
+                instance = super().create(validated_data)
+                services.Message.after_create([instance])
+            return instance
 
         class Meta:
             model = app_models.Message
             fields = ('id', 'owner', 'type', 'content', 'system_message_content', 'read', 'create_time')
+
+    class Broadcast(serializers.ModelSerializer):
+        id = serializers.IntegerField(read_only=True)
+        content = serializers.CharField(allow_null=False, allow_blank=False)
+        staff_only = serializers.BooleanField(allow_null=False, default=False)
+
+        status = serializers.CharField(read_only=True)
+        total = serializers.IntegerField(read_only=True)
+        delivered = serializers.IntegerField(read_only=True)
+
+        create_time = serializers.DateTimeField(read_only=True)
+        creator = serializers.CharField(read_only=True)
+        finish_time = serializers.DateTimeField(read_only=True)
+
+        class Meta:
+            model = app_models.Broadcast
+            fields = ('id', 'content', 'staff_only', 'status', 'total', 'delivered',
+                      'create_time', 'creator', 'finish_time')
@@ -1,6 +1,9 @@
 from django.utils import timezone
+from django.db import connection, transaction
 from django.db.models import F, Q
-from . import models as app_models, enums, statistics, exceptions as app_exceptions
+from . import models as app_models, enums, statistics, exceptions as app_exceptions, notify
+from datetime import timedelta
+import threading
 import uuid
 
 
@@ -22,13 +25,17 @@ class Message:
     @staticmethod
     def send_system_notice(owner, content):
         msg = app_models.Message(type=enums.MessageType.system, content={"content": content}, owner=owner)
-        msg.save()
+        with transaction.atomic():
+            msg.save()
+            Message.after_create([msg])
         return msg
 
     @staticmethod
     def send_chat(owner, sender, content):
         msg = app_models.Message(type=enums.MessageType.chat, content={"content": content}, owner=owner, sender=sender)
-        msg.save()
+        with transaction.atomic():
+            msg.save()
+            Message.after_create([msg])
         return msg
 
     @staticmethod
@@ -36,10 +43,222 @@ class Message:
         profile = app_models.Profile.objects.filter(id__exact=owner.id).first()
         if profile.animation_update_notice:
             msg = app_models.Message(type=enums.MessageType.update, content={"update": updates}, owner=owner)
-            msg.save()
+            with transaction.atomic():
+                msg.save()
+                Message.after_create([msg])
             return msg
         return None
 
+    @staticmethod
+    def after_create(messages):
+        """
+        新的message被保存之后调用。更新owner的未读计数，并向等待中的长轮询请求发出通知。
+        应当与message的保存处于同一个事务中。
+        :param messages:
+        :return:
+        """
+        unread = {}
+        for msg in messages:
+            if not msg.read:
+                unread[msg.owner_id] = unread.get(msg.owner_id, 0) + 1
+        # 增量相同的owner合并为一条update
+        owners_by_count = {}
+        for owner_id, count in unread.items():
+            owners_by_count.setdefault(count, []).append(owner_id)
+        for count, owner_ids in owners_by_count.items():
+            app_models.Profile.objects.filter(id__in=owner_ids)\
+                .update(unread_message_count=F('unread_message_count') + count)
+        notify.send(notify.CHANNEL_MESSAGE, [notify.message_payload(msg) for msg in messages])
+
+    @staticmethod
+    def set_read(message, read):
+        """
+        修改一条message的read状态，并同步维护owner的未读计数。
+        使用带条件的update，并发修改同一条message时计数也不会重复变化。
+        :param message:
+        :param read:
+        :return:
+        """
+        with transaction.atomic():
+            changed = app_models.Message.objects.filter(id=message.id, read=not read).update(read=read)
+            if changed > 0:
+                Message.change_unread_count(message.owner_id, -changed if read else changed)
+        message.read = read
+
+    @staticmethod
+    def mark_read(owner, until=None, message_type=None):
+        """
+        用一条update将owner的未读message批量标记为已读。
+        :param owner:
+        :param until: 只标记id不大于until的message。
+        :param message_type: 只标记该type的message。
+        :return: 标记之后的未读数量。
+        """
+        queryset = app_models.Message.objects.filter(owner=owner, read=False)
+        if until is not None:
+            queryset = queryset.filter(id__lte=until)
+        if message_type is not None:
+            queryset = queryset.filter(type=message_type)
+        with transaction.atomic():
+            changed = queryset.update(read=True)
+            if changed > 0:
+                Message.change_unread_count(owner.id, -changed)
+        return Message.unread_count(owner)
+
+    @staticmethod
+    def change_unread_count(owner_id, delta):
+        app_models.Profile.objects.filter(id=owner_id)\
+            .update(unread_message_count=F('unread_message_count') + delta)
+
+    @staticmethod
+    def unread_count(owner):
+        return app_models.Profile.objects.filter(id=owner.id).values_list('unread_message_count', flat=True).first()
+
+    @staticmethod
+    def archive(days, batch_size):
+        """
+        将创建时间早于days天之前的已读message分批移动到归档表。
+        每一批是一条独立的语句，只短暂锁住该批的行，并跳过其他事务正在修改的行。
+        :param days:
+        :param batch_size:
+        :return: 生成器，逐批产出本批归档的数量。
+        """
+        deadline = timezone.now() - timedelta(days=days)
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    with moved as (
+                      delete from api_message where id in (
+                        select id from api_message
+                        where read and create_time < %s
+                        order by create_time limit %s
+                        for update skip locked
+                      )
+                      returning id, owner_id, sender_id, type, content, create_time
+                    )
+                    insert into api_messagearchive (id, owner_id, sender_id, type, content, create_time, archive_time)
+                    select id, owner_id, sender_id, type, content, create_time, now() from moved
+                """, [deadline, batch_size])
+                count = cursor.rowcount
+            if count <= 0:
+                break
+            yield count
+
+    @staticmethod
+    def recount_unread():
+        """
+        按message表重新计算全部profile的未读计数。
+        :return: 被修正的profile的数量。
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                update api_profile p set unread_message_count = c.count
+                from (
+                  select ap.id, count(am.id) as count
+                  from api_profile ap
+                    left join api_message am on am.owner_id = ap.id and not am.read
+                  group by ap.id
+                ) c
+                where p.id = c.id and p.unread_message_count <> c.count
+            """)
+            return cursor.rowcount
+
+
+class Broadcast:
+    CHUNK_SIZE = 500
+
+    @staticmethod
+    def start(broadcast):
+        """
+        在后台线程中开始投递。
+        :param broadcast:
+        :return:
+        """
+        thread = threading.Thread(target=Broadcast.deliver_in_thread, args=(broadcast.id,), daemon=True)
+        thread.start()
+
+    @staticmethod
+    def deliver_in_thread(broadcast_id):
+        try:
+            Broadcast.deliver(broadcast_id)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def deliver(broadcast_id):
+        """
+        分批为目标profile创建系统通知。每一批在一个事务中锁定broadcast，从数据库中的cursor处bulk create并推进cursor，
+        因此中断之后再次调用会从cursor处继续；同一时刻只有一个worker能投递同一个broadcast，
+        锁被其他worker持有时直接返回。
+        :param broadcast_id:
+        :return: 是否投递完成。
+        """
+        with transaction.atomic():
+            broadcast = Broadcast.lock(broadcast_id)
+            if broadcast is None:
+                return False
+            if broadcast.status == enums.BroadcastStatus.done:
+                return True
+            broadcast.status = enums.BroadcastStatus.running
+            broadcast.total = broadcast.delivered + Broadcast.profiles(broadcast).filter(id__gt=broadcast.cursor).count()
+            broadcast.save(update_fields=['status', 'total'])
+        content = {'content': broadcast.content}
+        try:
+            while True:
+                with transaction.atomic():
+                    broadcast = Broadcast.lock(broadcast_id)
+                    if broadcast is None:
+                        return False
+                    if broadcast.status == enums.BroadcastStatus.done:
+                        return True
+                    owner_ids = list(Broadcast.profiles(broadcast).filter(id__gt=broadcast.cursor).order_by('id')
+                                     .values_list('id', flat=True)[:Broadcast.CHUNK_SIZE])
+                    if len(owner_ids) <= 0:
+                        broadcast.status = enums.BroadcastStatus.done
+                        broadcast.finish_time = timezone.now()
+                        broadcast.save(update_fields=['status', 'finish_time'])
+                        return True
+                    messages = app_models.Message.objects.bulk_create([
+                        app_models.Message(type=enums.MessageType.system, content=content, owner_id=owner_id)
+                        for owner_id in owner_ids
+                    ])
+                    Message.after_create(messages)
+                    broadcast.delivered += len(messages)
+                    broadcast.cursor = owner_ids[-1]
+                    broadcast.save(update_fields=['delivered', 'cursor'])
+        except Exception:
+            # 失败的一批已经回滚，只记录状态，不写入内存中这一批的delivered与cursor
+            app_models.Broadcast.objects.filter(id=broadcast_id).update(status=enums.BroadcastStatus.failed)
+            raise
+
+    @staticmethod
+    def lock(broadcast_id):
+        """
+        在当前事务中锁定broadcast并读取它的最新状态。
+        :return: broadcast；不存在或者正在被其他worker投递时返回None。
+        """
+        return app_models.Broadcast.objects.select_for_update(skip_locked=True).filter(id=broadcast_id).first()
+
+    @staticmethod
+    def profiles(broadcast):
+        profiles = app_models.Profile.objects.all()
+        if broadcast.staff_only:
+            profiles = profiles.filter(user__is_staff=True)
+        return profiles
+
+    @staticmethod
+    def unfinished():
+        return app_models.Broadcast.objects.exclude(status=enums.BroadcastStatus.done).order_by('id').all()
+
+    @staticmethod
+    def interrupted():
+        """
+        没有结束的broadcast(不包括失败的)。投递线程所在的进程退出后，它们会一直停留在这些状态。
+        正在被其他worker投递的会在deliver中被跳过。
+        """
+        return app_models.Broadcast.objects.filter(status__in=[enums.BroadcastStatus.pending,
+                                                               enums.BroadcastStatus.running]).order_by('id').all()
+
 
 class RegistrationCode:
     @staticmethod
@@ -48,6 +267,54 @@ class RegistrationCode:
 
 
 class Animation:
+    # 搜索文档的组成与原先的搜索范围一致：标题、关键字、标签名和三种staff的名字
+    DERIVED_FIELDS_SQL = """
+        update api_animation a set search_document = d.document, search_vector = to_tsvector('simple', d.document),
+          tag_ids = d.tag_ids, original_work_author_ids = d.author_ids,
+          staff_company_ids = d.company_ids, staff_supervisor_ids = d.supervisor_ids
+        from (
+          select aa.id, concat_ws(' ', aa.title, aa.origin_title, aa.other_title, aa.keyword,
+            (select string_agg(t.name, ' ')
+             from api_animation_tags aat inner join api_tag t on t.id = aat.tag_id
+             where aat.animation_id = aa.id),
+            (select string_agg(s.name, ' ')
+             from api_staff s
+             where s.id in (select staff_id from api_animation_original_work_authors where animation_id = aa.id
+                            union select staff_id from api_animation_staff_companies where animation_id = aa.id
+                            union select staff_id from api_animation_staff_supervisors where animation_id = aa.id))
+          ) as document,
+          array(select tag_id from api_animation_tags
+                where animation_id = aa.id order by tag_id) as tag_ids,
+          array(select staff_id from api_animation_original_work_authors
+                where animation_id = aa.id order by staff_id) as author_ids,
+          array(select staff_id from api_animation_staff_companies
+                where animation_id = aa.id order by staff_id) as company_ids,
+          array(select staff_id from api_animation_staff_supervisors
+                where animation_id = aa.id order by staff_id) as supervisor_ids
+          from api_animation aa
+          where aa.id = any(%s)
+        ) d
+        where a.id = d.id
+    """
+
+    @staticmethod
+    def refresh_derived(id_list):
+        """
+        重新生成这些animation的派生字段(搜索文档和关系id数组)。在animation本身、它的标签或staff发生变化之后调用。
+        :param id_list:
+        :return:
+        """
+        id_list = list(id_list)
+        if len(id_list) <= 0:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(Animation.DERIVED_FIELDS_SQL, [id_list])
+
+    @staticmethod
+    def ids_by_staff(staff):
+        return app_models.Animation.objects.filter(Q(original_work_authors=staff) | Q(staff_companies=staff) |
+                                                   Q(staff_supervisors=staff)).values_list('id', flat=True).distinct()
+
     @staticmethod
     def refresh_published():
         print('Animation refresh published.')
@@ -102,6 +369,18 @@ class Animation:
         return count
 
 
+class Database:
+    @staticmethod
+    def changed(kind, id_list):
+        """
+        animation、tag或staff被写入之后调用，通知各进程更新内存中的派生数据。
+        :param kind: 'animation', 'tag'或'staff'。
+        :param id_list:
+        :return:
+        """
+        notify.send(notify.CHANNEL_DATABASE, [notify.database_payload(kind, i) for i in id_list])
+
+
 class Setting:
     @staticmethod
     def exists():
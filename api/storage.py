@@ -0,0 +1,253 @@
+"""
+封面文件的存储后端。
+所有对封面文件的读写都经过get_storage()返回的Storage，按COVER_STORAGE['TYPE']选择实现：
+'fs'为本地文件，'oss'为阿里云oss，'memory'为进程内的替身，用于测试和基准测试。
+后端在第一次使用时才初始化；持有连接的后端在fork出的子进程中会重新创建，不与父进程共享连接。
+"""
+from AnimationBoard.settings import COVER_DIRS, STATIC_URL
+import abc
+import hashlib
+import os
+import threading
+import time
+import oss2
+import config
+
+
+class Storage(abc.ABC):
+    # 可以重试的错误
+    TRANSIENT_ERRORS = ()
+    # 不持有连接，fork出的子进程可以继续使用父进程的实例
+    FORK_SAFE = True
+    # 写入的内容对其他进程可见。为False时不能在工作进程中写入，由调用方在本进程中执行
+    SHARED = True
+
+    @abc.abstractmethod
+    def put(self, name, data):
+        pass
+
+    def put_file(self, name, path):
+        with open(path, 'rb') as f:
+            self.put(name, f.read())
+
+    @abc.abstractmethod
+    def get(self, name):
+        """
+        :return: bytes；不存在时返回None。
+        """
+        pass
+
+    def delete(self, name):
+        self.batch_delete([name])
+
+    @abc.abstractmethod
+    def batch_delete(self, names):
+        pass
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    @abc.abstractmethod
+    def head(self, name):
+        """
+        :return: (字节数, MD5的hex或None)；不存在时返回None。
+        """
+        pass
+
+    @abc.abstractmethod
+    def names(self):
+        """
+        :return: 全部文件名的迭代器。
+        """
+        pass
+
+    @abc.abstractmethod
+    def sign(self, name):
+        """
+        :return: (可以访问该文件的url, url过期的时间戳或None)；没有可以访问的url时返回(None, None)，由接口直接返回内容。
+        """
+        pass
+
+    def local_path(self, name):
+        """
+        :return: 文件在本地的路径；不是本地存储时返回None。
+        """
+        return None
+
+
+class FileSystemStorage(Storage):
+    def __init__(self, root=COVER_DIRS, url_prefix='%scover/' % (STATIC_URL,)):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def path(self, name):
+        return '%s/%s' % (self.root, name)
+
+    def put(self, name, data):
+        # 存储路径不存在时先创建路径
+        if not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+
+    def get(self, name):
+        try:
+            with open(self.path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def batch_delete(self, names):
+        for name in names:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def head(self, name):
+        try:
+            return os.path.getsize(self.path(name)), None
+        except FileNotFoundError:
+            return None
+
+    def names(self):
+        if not os.path.exists(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.startswith('.'):
+                yield entry.name
+
+    def sign(self, name):
+        return self.url_prefix + name, None
+
+    def local_path(self, name):
+        return self.path(name)
+
+
+class OssStorage(Storage):
+    TRANSIENT_ERRORS = (oss2.exceptions.RequestError, oss2.exceptions.ServerError)
+    FORK_SAFE = False
+    BATCH_DELETE_MAX = 1000
+
+    def __init__(self, endpoint=None, bucket_name=None):
+        oss_config = config.COVER_STORAGE['OSS']
+        self.endpoint = endpoint or oss_config['endpoint']
+        self.bucket_name = bucket_name or oss_config['bucket_name']
+        self.sign_timeout = oss_config['sign_timeout']
+        self.lock = threading.Lock()
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            with self.lock:
+                if self._bucket is None:
+                    oss_config = config.COVER_STORAGE['OSS']
+                    auth = oss2.Auth(oss_config['access_key_id'], oss_config['access_key_secret'])
+                    # 同一个session复用到oss的连接
+                    self._bucket = oss2.Bucket(auth, self.endpoint, self.bucket_name, session=oss2.Session())
+        return self._bucket
+
+    def put(self, name, data):
+        self.bucket.put_object(name, data)
+
+    def put_file(self, name, path):
+        self.bucket.put_object_from_file(name, path)
+
+    def get(self, name):
+        try:
+            return self.bucket.get_object(name).read()
+        except oss2.exceptions.NoSuchKey:
+            return None
+
+    def batch_delete(self, names):
+        names = list(names)
+        for i in range(0, len(names), self.BATCH_DELETE_MAX):
+            self.bucket.batch_delete_objects(names[i:i + self.BATCH_DELETE_MAX])
+
+    def exists(self, name):
+        return self.bucket.object_exists(name)
+
+    def head(self, name):
+        try:
+            meta = self.bucket.head_object(name)
+        except oss2.exceptions.NotFound:
+            return None
+        # 简单上传的对象的ETag就是内容的MD5
+        return meta.content_length, meta.etag.strip('"').lower()
+
+    def names(self):
+        for obj in oss2.ObjectIterator(self.bucket):
+            yield obj.key
+
+    def sign(self, name):
+        from api.oss import sign_cache
+        return sign_cache.get(name, self.sign_without_cache)
+
+    def sign_without_cache(self, name):
+        url = 'https' + self.bucket.sign_url('GET', name, self.sign_timeout)[4:]
+        return url, time.time() + self.sign_timeout
+
+
+class MemoryStorage(Storage):
+    """
+    进程内的替身，用于测试和基准测试，行为与oss一致：head返回内容的MD5。
+    内容只存在于本进程中：封面处理和png2jpg在使用它时改为在本进程的线程中执行；
+    没有可以访问的url，封面接口直接返回内容。
+    """
+    SHARED = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def put(self, name, data):
+        with self.lock:
+            self.data[name] = bytes(data)
+
+    def get(self, name):
+        with self.lock:
+            return self.data.get(name)
+
+    def batch_delete(self, names):
+        with self.lock:
+            for name in names:
+                self.data.pop(name, None)
+
+    def head(self, name):
+        data = self.get(name)
+        if data is None:
+            return None
+        return len(data), hashlib.md5(data).hexdigest()
+
+    def names(self):
+        with self.lock:
+            return iter(list(self.data.keys()))
+
+    def sign(self, name):
+        return None, None
+
+
+STORAGE_TYPES = {
+    'fs': FileSystemStorage,
+    'oss': OssStorage,
+    'memory': MemoryStorage
+}
+
+storage = None
+storage_pid = None
+storage_lock = threading.Lock()
+
+
+def get_storage():
+    """获得本进程的存储后端。第一次调用时创建。"""
+    global storage, storage_pid
+    if storage is None or (storage_pid != os.getpid() and not storage.FORK_SAFE):
+        with storage_lock:
+            if storage is None or (storage_pid != os.getpid() and not storage.FORK_SAFE):
+                storage = STORAGE_TYPES[config.COVER_STORAGE['TYPE']]()
+                storage_pid = os.getpid()
+    return storage
@@ -0,0 +1,193 @@
+"""
+animation标题、tag名和staff名的输入提示。
+每个进程在内存中维护一份按key排序的索引，服务进程启动时(wsgi.py)在后台构建，其他进程在第一次使用时构建；
+之后通过notify的database频道接收任意进程的写入通知，增量更新对应的条目。
+"""
+from django.db import connection
+from . import models as app_models, notify
+import bisect
+import threading
+import unicodedata
+
+KIND_ANIMATION = 'animation'
+KIND_TAG = 'tag'
+KIND_STAFF = 'staff'
+KINDS = (KIND_ANIMATION, KIND_TAG, KIND_STAFF)
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text).casefold().strip()
+
+
+def load(kind, id_list=None):
+    """
+    从数据库读取条目。
+    :return: 生成器，产出(kind, id, 显示名, [可匹配的名字])。
+    """
+    if kind == KIND_ANIMATION:
+        queryset = app_models.Animation.objects.values_list('id', 'title', 'origin_title', 'other_title')
+    elif kind == KIND_TAG:
+        queryset = app_models.Tag.objects.values_list('id', 'name')
+    elif kind == KIND_STAFF:
+        queryset = app_models.Staff.objects.values_list('id', 'name', 'origin_name')
+    else:
+        return
+    if id_list is not None:
+        queryset = queryset.filter(id__in=id_list)
+    for row in queryset.iterator():
+        yield kind, row[0], row[1], [name for name in row[1:] if name]
+
+
+class SuggestIndex(object):
+    """
+    条目以(key, kind, id, full)的形式按key排序存储，full表示key是完整的名字，否则是名字中某个词开始的后缀。
+    查询时先用二分查找做前缀匹配，数量不足时再在完整名字中做子串匹配。
+    """
+    PREFIX_SCAN_MAX = 2000      # 一次前缀匹配最多检查的条目数
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries = []       # [(key, kind, id, full)]
+        self.items = {}         # (kind, id) -> (显示名, [entry])
+        self.ready = False
+        self.pending = set()    # 构建期间收到的写入通知
+
+    @staticmethod
+    def make_entries(kind, obj_id, names):
+        entries = set()
+        for name in names:
+            key = normalize(name)
+            if not key:
+                continue
+            entries.add((key, kind, obj_id, True))
+            words = key.split()
+            for i in range(1, len(words)):
+                entries.add((' '.join(words[i:]), kind, obj_id, False))
+        return sorted(entries)
+
+    def build(self):
+        with self.lock:
+            self.pending.clear()
+        entries = []
+        items = {}
+        for kind in KINDS:
+            for kind_, obj_id, name, names in load(kind):
+                item_entries = self.make_entries(kind_, obj_id, names)
+                items[(kind_, obj_id)] = (name, item_entries)
+                entries += item_entries
+        entries.sort()
+        with self.lock:
+            self.entries = entries
+            self.items = items
+            self.ready = True
+            pending, self.pending = self.pending, set()
+            for kind, obj_id in pending:
+                self.reload(kind, obj_id)
+
+    def put(self, kind, obj_id, name, names):
+        with self.lock:
+            self.remove(kind, obj_id)
+            item_entries = self.make_entries(kind, obj_id, names)
+            self.items[(kind, obj_id)] = (name, item_entries)
+            for entry in item_entries:
+                bisect.insort(self.entries, entry)
+
+    def remove(self, kind, obj_id):
+        with self.lock:
+            item = self.items.pop((kind, obj_id), None)
+            if item is None:
+                return
+            for entry in item[1]:
+                i = bisect.bisect_left(self.entries, entry)
+                if i < len(self.entries) and self.entries[i] == entry:
+                    del self.entries[i]
+
+    def reload(self, kind, obj_id):
+        rows = list(load(kind, [obj_id]))
+        if len(rows) > 0:
+            self.put(*rows[0])
+        else:
+            self.remove(kind, obj_id)
+
+    def search(self, text, limit, kinds=KINDS):
+        """
+        :param text:
+        :param limit:
+        :param kinds: 限定的条目类型。
+        :return: [{type, id, name}]，按完全匹配、名字前缀、词前缀、子串匹配的顺序，同级按名字长度、名字排序。
+        """
+        q = normalize(text)
+        if not q:
+            return []
+        found = {}
+        with self.lock:
+            i = bisect.bisect_left(self.entries, (q,))
+            end = min(len(self.entries), i + self.PREFIX_SCAN_MAX)
+            while i < end:
+                key, kind, obj_id, full = self.entries[i]
+                if not key.startswith(q):
+                    break
+                if kind in kinds:
+                    score = (0 if key == q and full else 1 if full else 2, len(key))
+                    if score < found.get((kind, obj_id), (4,))[0:2]:
+                        found[(kind, obj_id)] = score + (self.items[(kind, obj_id)][0],)
+                i += 1
+            # 子串匹配要遍历全部条目，只在锁内复制一份快照，遍历在锁外进行
+            items = list(self.items.items()) if len(found) < limit else []
+        # 子串匹配需要收集全部结果后再排序，否则结果取决于条目的加载顺序
+        for (kind, obj_id), (name, item_entries) in items:
+            if kind not in kinds or (kind, obj_id) in found:
+                continue
+            lengths = [len(key) for key, _, _, full in item_entries if full and q in key]
+            if lengths:
+                found[(kind, obj_id)] = (3, min(lengths), name)
+        ranked = sorted(found.items(), key=lambda item: item[1] + item[0])[:limit]
+        return [{'type': kind, 'id': obj_id, 'name': score[2]} for (kind, obj_id), score in ranked]
+
+    def on_notify(self, payload):
+        kind, obj_id = payload.split(':')
+        if kind not in KINDS:
+            return
+        try:
+            with self.lock:
+                if self.ready:
+                    self.reload(kind, int(obj_id))
+                else:
+                    self.pending.add((kind, int(obj_id)))
+                    return
+        finally:
+            # 监听线程不处于请求周期中，用完立即归还连接
+            connection.close()
+
+    def on_reset(self):
+        # 监听断开期间可能遗漏了写入通知，下次使用时重新构建
+        with self.lock:
+            self.ready = False
+
+
+index = SuggestIndex()
+index_lock = threading.Lock()
+subscribed = False
+
+
+def warm_up():
+    """在后台线程中构建本进程的索引，使第一个请求不必等待构建。"""
+    def run():
+        try:
+            get_index()
+        finally:
+            connection.close()
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_index():
+    """获得本进程的索引。第一次调用时订阅写入通知并构建索引。"""
+    global subscribed
+    if not index.ready:
+        with index_lock:
+            if not subscribed:
+                notify.listener.subscribe(notify.CHANNEL_DATABASE, index.on_notify, index.on_reset)
+                subscribed = True
+            if not index.ready:
+                index.build()
+    return index
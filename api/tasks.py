@@ -1,5 +1,26 @@
-from . import services
+from AnimationBoard.settings import MESSAGE_ARCHIVE_SETTINGS
+from . import services, covers
 
 
 def delivery_publish_task():
     services.Animation.refresh_published()
+
+
+def message_archive_task():
+    count = 0
+    for batch in services.Message.archive(MESSAGE_ARCHIVE_SETTINGS['days'], MESSAGE_ARCHIVE_SETTINGS['batch_size']):
+        count += batch
+    print('Message archived %s.' % (count,))
+
+
+def cover_sweep_task():
+    pending_count, stash_count = covers.sweep(60 * 60)
+    print('Cover sweep cleared %s pending, removed %s stashed.' % (pending_count, stash_count))
+
+
+def broadcast_resume_task():
+    resumed = 0
+    for broadcast in services.Broadcast.interrupted():
+        if services.Broadcast.deliver(broadcast.id):
+            resumed += 1
+    print('Broadcast resumed %s.' % (resumed,))
@@ -1,3 +1,405 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import SimpleTestCase, TransactionTestCase, tag
+from rest_framework.test import APIRequestFactory
+from rest_framework.test import force_authenticate
+from rest_framework.request import Request
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+from unittest import mock
+from PIL import Image
+from . import covers as app_covers, storage as app_storage, views as app_views, oss as app_oss
+from . import models as app_models, services, enums, pagination as app_pagination, suggest as app_suggest
+from .management.commands import fs2oss
+import hashlib
+import io
+import os
+import tempfile
+import time
 
-# Create your tests here.
+
+def make_image(width, height, fmt='JPEG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'red').save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def use_storage(storage):
+    """在测试期间用storage替换本进程的存储后端。"""
+    return mock.patch.multiple(app_storage, storage=storage, storage_pid=os.getpid())
+
+
+class CoverViewTest(SimpleTestCase):
+    NAME = 'animation-1-test.jpg'
+
+    def setUp(self):
+        self.storage = app_storage.MemoryStorage()
+        patcher = use_storage(self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app_covers.exists.cache_clear()
+        self.addCleanup(app_covers.exists.cache_clear)
+        app_covers.process(self.NAME, make_image(800, 600))
+        self.view = app_views.Cover.as_view({'get': 'list'})
+
+    def get(self, **params):
+        return self.view(APIRequestFactory().get('/cover/', dict(id=self.NAME, **params)))
+
+    def test_select_each_type(self):
+        for fmt, expected in (('jpg', 'animation-1-test@96.jpg'), ('jpeg', 'animation-1-test@96.jpg'),
+                              ('webp', 'animation-1-test@96.webp')):
+            with self.subTest(type=fmt):
+                res = self.get(size=96, type=fmt)
+                # memory存储没有url，直接返回内容
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res['ETag'], '"%s"' % (expected,))
+                self.assertEqual(res['Content-Type'], app_covers.content_type(expected))
+                self.assertEqual(res.content, self.storage.get(expected))
+
+    def test_original_without_parameters(self):
+        res = self.get()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['ETag'], '"%s"' % (self.NAME,))
+        self.assertIn('immutable', res['Cache-Control'])
+
+    def test_negotiate_webp_from_accept(self):
+        res = self.view(APIRequestFactory().get('/cover/', {'id': self.NAME, 'size': 192},
+                                                HTTP_ACCEPT='image/webp,*/*'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['ETag'], '"animation-1-test@192.webp"')
+        self.assertIn('Accept', res['Vary'])
+
+    def test_not_modified(self):
+        res = self.view(APIRequestFactory().get('/cover/', {'id': self.NAME}, HTTP_IF_NONE_MATCH='"%s"' % (self.NAME,)))
+        self.assertEqual(res.status_code, 304)
+
+    def test_missing_cover(self):
+        res = self.view(APIRequestFactory().get('/cover/', {'id': 'animation-2-missing.jpg'}))
+        self.assertEqual(res.status_code, 404)
+
+
+class OpenImageTest(SimpleTestCase):
+    def test_decompression_bomb_is_rejected(self):
+        buffer = io.BytesIO()
+        Image.new('1', (14000, 14000)).save(buffer, format='PNG')
+        buffer.seek(0)
+        with self.assertRaises(app_covers.ImageRejected):
+            app_covers.open_image(buffer)
+
+    def test_too_many_pixels_closes_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as f:
+            f.write(make_image(400, 300, 'PNG'))
+        self.addCleanup(os.remove, f.name)
+        opened = []
+        original_open = Image.open
+
+        def spy(*args, **kwargs):
+            opened.append(original_open(*args, **kwargs))
+            return opened[-1]
+
+        with mock.patch.object(app_covers, 'MAX_PIXELS', 1000), mock.patch.object(Image, 'open', spy):
+            with self.assertRaises(app_covers.ImageRejected):
+                app_covers.open_image(f.name)
+        self.assertIsNone(opened[0].fp)
+
+    def test_unknown_data_is_rejected(self):
+        with self.assertRaises(app_covers.ImageRejected):
+            app_covers.open_image(io.BytesIO(b'not an image'))
+
+
+class SignCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def sign(self, name):
+        self.calls.append(name)
+        return 'https://oss/%s' % (name,), time.time() + 100
+
+    def test_evict_least_recently_used(self):
+        cache = app_oss.SignCache(2, 10)
+        cache.get('a', self.sign)
+        cache.get('b', self.sign)
+        cache.get('a', self.sign)
+        cache.get('c', self.sign)
+        self.assertEqual(list(cache.data.keys()), ['a', 'c'])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_refresh_before_expire(self):
+        cache = app_oss.SignCache(10, 200)
+        cache.get('a', self.sign)
+        cache.get('a', self.sign)
+        self.assertEqual(self.calls, ['a', 'a'])
+
+
+class FlakyStorage(app_storage.MemoryStorage):
+    """前failures次上传抛出可以重试的错误。"""
+    TRANSIENT_ERRORS = (ConnectionError,)
+
+    def __init__(self, failures=0):
+        super().__init__()
+        self.failures = failures
+        self.puts = 0
+
+    def put_file(self, name, path):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+        self.puts += 1
+        super().put_file(name, path)
+
+
+class Fs2OssTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_skip_existing_object_of_same_size(self):
+        storage = FlakyStorage()
+        path = self.write('a.jpg', b'abc')
+        self.assertTrue(fs2oss.upload(storage, 'a.jpg', path, 3))
+        self.assertFalse(fs2oss.upload(storage, 'a.jpg', path, 3))
+        self.assertEqual(storage.puts, 1)
+
+    def test_checksum_detects_changed_content(self):
+        storage = FlakyStorage()
+        storage.put('a.jpg', b'xyz')
+        path = self.write('a.jpg', b'abc')
+        self.assertFalse(fs2oss.upload(storage, 'a.jpg', path, 3))
+        self.assertTrue(fs2oss.upload(storage, 'a.jpg', path, 3, checksum=True))
+        self.assertEqual(storage.head('a.jpg')[1], hashlib.md5(b'abc').hexdigest())
+
+    def test_retry_transient_errors(self):
+        path = self.write('a.jpg', b'abc')
+        storage = FlakyStorage(failures=2)
+        self.assertTrue(fs2oss.upload(storage, 'a.jpg', path, 3, retries=3, backoff=0))
+        storage = FlakyStorage(failures=2)
+        with self.assertRaises(ConnectionError):
+            fs2oss.upload(storage, 'a.jpg', path, 3, retries=1, backoff=0)
+
+    def test_resume_from_manifest(self):
+        source = os.path.join(self.dir.name, 'cover')
+        os.makedirs(source)
+        for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+            with open(os.path.join(source, name), 'wb') as f:
+                f.write(name.encode())
+        manifest = os.path.join(self.dir.name, 'manifest')
+        storage = FlakyStorage()
+        with mock.patch.object(fs2oss, 'COVER_DIRS', source), \
+                mock.patch.object(fs2oss.Command, 'get_storage', staticmethod(lambda *args: storage)):
+            call_command('fs2oss', manifest=manifest, workers=2, stdout=io.StringIO())
+            self.assertEqual(sorted(storage.names()), ['a.jpg', 'b.jpg', 'c.jpg'])
+            self.assertEqual(storage.puts, 3)
+            out = io.StringIO()
+            call_command('fs2oss', manifest=manifest, workers=2, stdout=out)
+        self.assertIn('0 files to upload, 3 already in manifest.', out.getvalue())
+        self.assertEqual(storage.puts, 3)
+
+
+class MemoryStorageTest(SimpleTestCase):
+    def setUp(self):
+        self.storage = app_storage.MemoryStorage()
+
+    def test_put_get_head(self):
+        self.assertIsNone(self.storage.get('a'))
+        self.assertIsNone(self.storage.head('a'))
+        self.storage.put('a', b'abc')
+        self.assertEqual(self.storage.get('a'), b'abc')
+        self.assertEqual(self.storage.head('a'), (3, hashlib.md5(b'abc').hexdigest()))
+        self.assertTrue(self.storage.exists('a'))
+
+    def test_batch_delete(self):
+        for name in ('a', 'b', 'c'):
+            self.storage.put(name, name.encode())
+        self.storage.batch_delete(['a', 'b', 'missing'])
+        self.assertEqual(list(self.storage.names()), ['c'])
+        self.storage.delete('c')
+        self.assertEqual(list(self.storage.names()), [])
+
+    def test_sign_has_no_url(self):
+        self.assertEqual(self.storage.sign('a'), (None, None))
+
+    def test_not_shared_with_workers(self):
+        self.assertFalse(self.storage.SHARED)
+        executor = app_covers.executor
+        self.addCleanup(setattr, app_covers, 'executor', executor)
+        with use_storage(self.storage):
+            self.assertIsInstance(app_covers.get_executor(renew=True), ThreadPoolExecutor)
+            app_covers.executor.shutdown()
+
+    def test_abstract_methods(self):
+        with self.assertRaises(TypeError):
+            app_storage.Storage()
+
+
+class StashUploadTest(SimpleTestCase):
+    def test_temporary_file_is_moved(self):
+        data = make_image(200, 100)
+        upload = TemporaryUploadedFile('cover.jpg', 'image/jpeg', len(data), None)
+        upload.write(data)
+        upload.seek(0)
+        original = upload.temporary_file_path()
+        path = app_covers.stash_upload(upload)
+        self.addCleanup(os.remove, path)
+        upload.close()
+        self.assertFalse(os.path.exists(original))
+        self.assertTrue(os.path.basename(path).startswith(app_covers.STASH_PREFIX))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_memory_file_is_read(self):
+        data = make_image(200, 100)
+        self.assertEqual(app_covers.stash_upload(SimpleUploadedFile('cover.jpg', data, 'image/jpeg')), data)
+
+    def test_too_large(self):
+        upload = SimpleUploadedFile('cover.jpg', b'0' * 11, 'image/jpeg')
+        with mock.patch.object(app_covers, 'MAX_BYTES', 10):
+            with self.assertRaises(app_covers.ImageRejected):
+                app_covers.stash_upload(upload)
+
+
+@tag('database')
+class CoverUploadTest(TransactionTestCase):
+    """从上传到处理完成再到读取封面的完整流程。处理在线程中完成后，finish使用另一个数据库连接，因此不能使用TestCase。"""
+    def setUp(self):
+        self.storage = app_storage.MemoryStorage()
+        patcher = use_storage(self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app_covers.exists.cache_clear()
+        self.addCleanup(app_covers.exists.cache_clear)
+        executor = app_covers.executor
+        self.addCleanup(setattr, app_covers, 'executor', executor)
+        app_covers.get_executor(renew=True)
+        self.user = services.Profile.create_full_user(username='staff', name='Staff', password='staff',
+                                                      is_staff=True, is_superuser=False,
+                                                      create_path=enums.ProfileCreatePath.system).user
+        self.animation = app_models.Animation.objects.create(
+            title='Test', publish_type='GENERAL', published_record=[], publish_plan=[], subtitle_list=[], links=[],
+            relations={}, original_relations={}, creator='staff')
+
+    def test_upload_and_serve(self):
+        upload = io.BytesIO(make_image(1200, 800))
+        upload.name = 'cover.jpg'
+        request = APIRequestFactory().post('/cover/animation/', {'id': self.animation.id, 'cover': upload},
+                                           format='multipart')
+        force_authenticate(request, user=self.user)
+        res = app_views.Cover.Animation.as_view({'post': 'create'})(request)
+        self.assertEqual(res.status_code, 202)
+        name = res.data['cover_pending']
+        self.assertIsNone(res.data['cover'])
+        # 等待后台处理和finish回调结束
+        app_covers.executor.shutdown(wait=True)
+
+        self.animation.refresh_from_db()
+        self.assertEqual(self.animation.cover, name)
+        self.assertIsNone(self.animation.cover_pending)
+        self.assertIsNone(self.animation.cover_pending_time)
+        stored = set(self.storage.names())
+        self.assertIn(name, stored)
+        for size, fmt in app_covers.variants():
+            self.assertIn(app_covers.variant_name(name, size, fmt), stored)
+
+        res = app_views.Cover.as_view({'get': 'list'})(APIRequestFactory().get('/cover/', {'id': name, 'type': 'webp'}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'image/webp')
+
+
+@tag('database')
+class CoverFinishTest(TransactionTestCase):
+    """相关的两个animation同时结束处理时，扩散缓存不能覆盖对方刚写入的cover。"""
+    def setUp(self):
+        self.storage = app_storage.MemoryStorage()
+        patcher = use_storage(self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, title):
+        return app_models.Animation.objects.create(
+            title=title, publish_type='GENERAL', published_record=[], publish_plan=[], subtitle_list=[], links=[],
+            relations={}, original_relations={}, creator='staff')
+
+    def test_concurrent_finish_on_related(self):
+        for i in range(5):
+            a, b = self.create('A'), self.create('B')
+            a.relations = {'NEXT': [{'id': b.id, 'title': 'B', 'cover': None}]}
+            b.relations = {'PREV': [{'id': a.id, 'title': 'A', 'cover': None}]}
+            names = {a.id: 'animation-%s-%s.jpg' % (a.id, i), b.id: 'animation-%s-%s.jpg' % (b.id, i)}
+            for animation in (a, b):
+                animation.cover_pending = names[animation.id]
+                animation.save()
+            barrier = Barrier(2)
+
+            def run(pk):
+                barrier.wait()
+                app_covers.finish(app_models.Animation, pk, names[pk], None)
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                for future in [pool.submit(run, a.id), pool.submit(run, b.id)]:
+                    future.result()
+
+            a.refresh_from_db()
+            b.refresh_from_db()
+            self.assertEqual(a.cover, names[a.id])
+            self.assertEqual(b.cover, names[b.id])
+            self.assertIsNone(a.cover_pending)
+            self.assertIsNone(b.cover_pending)
+            self.assertEqual(a.relations['NEXT'][0]['cover'], names[b.id])
+            self.assertEqual(b.relations['PREV'][0]['cover'], names[a.id])
+
+
+class ListPaginationTest(SimpleTestCase):
+    class View:
+        estimate_count = True
+
+    def paginate(self, rows, estimate, **params):
+        paginator = app_pagination.ListPagination()
+        request = Request(APIRequestFactory().get('/', params))
+        with mock.patch.object(app_pagination, 'estimate_count', return_value=estimate):
+            return paginator, paginator.paginate_queryset(rows, request, self.View())
+
+    def test_underestimated_count_still_returns_rows(self):
+        rows = list(range(5000))
+        paginator, results = self.paginate(rows, 1500, offset=2000, limit=10)
+        self.assertEqual(results, list(range(2000, 2010)))
+        self.assertTrue(paginator.estimated)
+        self.assertGreater(paginator.count, 2010)
+
+    def test_count_corrected_at_the_end(self):
+        paginator, results = self.paginate(list(range(1200)), 5000, offset=1195, limit=10)
+        self.assertEqual(results, list(range(1195, 1200)))
+        self.assertEqual(paginator.count, 1200)
+
+    def test_exact_below_threshold(self):
+        paginator, results = self.paginate(list(range(50)), 10, offset=40, limit=20)
+        self.assertFalse(paginator.estimated)
+        self.assertEqual(paginator.count, 50)
+        self.assertEqual(results, list(range(40, 50)))
+
+    def test_filtered_queryset_is_not_estimated(self):
+        self.assertIsNone(app_pagination.estimate_count(app_models.Animation.objects.filter(title='a')))
+
+
+class SuggestIndexTest(SimpleTestCase):
+    def make_index(self, rows):
+        index = app_suggest.SuggestIndex()
+        for obj_id, names in rows:
+            index.put(app_suggest.KIND_ANIMATION, obj_id, names[0], names)
+        return index
+
+    def test_prefix_before_substring(self):
+        index = self.make_index([(1, ['Love Live']), (2, ['Clover']), (3, ['Lovely'])])
+        names = [item['name'] for item in index.search('love', 10)]
+        self.assertEqual(names, ['Lovely', 'Love Live', 'Clover'])
+
+    def test_substring_ranked_by_length(self):
+        rows = [(1, ['A Very Long Title Removed']), (2, ['Glove']), (3, ['Gloves']), (4, ['Beloved'])]
+        # 加载顺序不影响结果
+        for order in (rows, rows[::-1]):
+            index = self.make_index(order)
+            self.assertEqual([item['id'] for item in index.search('ove', 2)], [2, 3])
+            self.assertEqual([item['id'] for item in index.search('ove', 10)], [2, 3, 4, 1])
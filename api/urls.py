@@ -21,6 +21,7 @@ router.register('profile/messages', app_views.Profile.Message, base_name='api-pr
 router.register('database/animations', app_views.Database.Animation, base_name='api-database-animation')
 router.register('database/staffs', app_views.Database.Staff, base_name='api-database-staff')
 router.register('database/tags', app_views.Database.Tag, base_name='api-database-tag')
+router.register('database/suggest', app_views.Database.Suggest, base_name='api-database-suggest')
 
 router.register('personal/diaries', app_views.Personal.Diary, base_name='api-personal-diary')
 router.register('personal/comments', app_views.Personal.Comment, base_name='api-personal-comment')
@@ -32,6 +33,8 @@ router.register('admin/users', app_views.Admin.User, base_name='api-admin-user')
 router.register('admin/users-permission', app_views.Admin.Permission, base_name='api-admin-permission')
 router.register('admin/registration-code', app_views.Admin.RegistrationCode, base_name='api-admin-registration-code')
 router.register('admin/system-messages', app_views.Admin.SystemMessage, base_name='api-admin-system-message')
+router.register('admin/broadcasts', app_views.Admin.Broadcast, base_name='api-admin-broadcast')
+router.register('admin/cover-stats', app_views.Admin.CoverStats, base_name='api-admin-cover-stats')
 
 urlpatterns = []
 urlpatterns += router.urls
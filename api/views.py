@@ -1,15 +1,19 @@
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, HttpResponseRedirect
 from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.contrib.auth import authenticate, login, logout
 from django.utils import timezone
-from rest_framework import viewsets, response, status, exceptions, permissions, mixins
+from django.db import connection as db_connection, transaction
+from django.db.models import F, Max, Prefetch
+from rest_framework import viewsets, response, status, exceptions, permissions, mixins, filters
 from rest_framework.decorators import action
 from rest_framework.authtoken.models import Token
+from django_filters.rest_framework import DjangoFilterBackend
 from . import exceptions as app_exceptions, serializers as app_serializers, filters as app_filters, statistics
 from . import permissions as app_permissions, models as app_models, enums, services, relations as app_relations
-from AnimationBoard.settings import COVER_DIRS, STATIC_URL
-from PIL import Image
-import os
+from . import notify, pagination as app_pagination, suggest as app_suggest, facets as app_facets
+from . import covers as app_covers, storage as app_storage
+import time
 import uuid
 import config
 
@@ -142,16 +146,80 @@ class User:
 
 
 class Cover(viewsets.ViewSet):
+    FILE_MAX_AGE = 60 * 60 * 24 * 365
+    REDIRECT_MAX_AGE = config.COVER_STORAGE.get('REDIRECT_MAX_AGE', 60 * 60 * 24)
+    REDIRECT_EXPIRE_MARGIN = 60 * 10
+    DIRECT_SERVE = config.COVER_STORAGE.get('DIRECT_SERVE', False)
+
     @staticmethod
     def list(request):
+        """
+        重定向到封面文件。可以用size(像素)和type(jpg/webp)参数选择变体；
+        没有指定type时，若Accept中包含image/webp则使用webp。
+        format参数已被DRF用于选择renderer，因此格式参数使用type。
+        按需生成的变体、开启了DIRECT_SERVE时fs存储中的文件，以及没有url的存储(memory)中的文件，会直接返回文件内容。
+        """
         index = request.query_params.get('id')
         if index is None or len(index) <= 0:
             return response.Response('Not Found.', status=404)
-        if config.COVER_STORAGE['TYPE'] == 'oss':
-            from api.oss import bucket, sign_url
-            return HttpResponseRedirect(sign_url(index))
+        size = request.query_params.get('size')
+        try:
+            size = int(size) if size else None
+        except ValueError:
+            raise app_exceptions.ApiError('WrongParameterType', 'parameter "size" must be int.')
+        fmt = request.query_params.get('type')
+        negotiated = False
+        if fmt == 'jpeg':
+            fmt = 'jpg'
+        elif not fmt:
+            negotiated = True
+            fmt = 'webp' if 'image/webp' in request.META.get('HTTP_ACCEPT', '') else None
+        storage = app_storage.get_storage()
+        name, path = app_covers.choose_variant(index, size, fmt)
+        if path is None and Cover.DIRECT_SERVE and app_covers.is_safe_name(name):
+            path = storage.local_path(name)
+        file = None
+        if path is not None:
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                # 刚好被其他进程淘汰，或者原图不存在
+                name = index
+        url, expire, content = None, None, None
+        if file is None:
+            url, expire = storage.sign(name)
+            if url is None:
+                # 存储没有可以访问的url(memory)，直接返回内容
+                content = storage.get(name)
+                if content is None:
+                    return response.Response('Not Found.', status=404)
+        if url is None:
+            # 文件名带有uuid，同名文件的内容不会改变，因此可以永久缓存
+            etag = '"%s"' % (name,)
+            if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+                if file is not None:
+                    file.close()
+                res = HttpResponseNotModified()
+            elif file is not None:
+                res = FileResponse(file, content_type=app_covers.content_type(name))
+            else:
+                res = HttpResponse(content, content_type=app_covers.content_type(name))
+            res['ETag'] = etag
+            patch_cache_control(res, public=True, max_age=Cover.FILE_MAX_AGE, immutable=True)
         else:
-            return HttpResponseRedirect('%scover/%s' % (STATIC_URL, index))
+            res = HttpResponseRedirect(url)
+            if expire is None:
+                patch_cache_control(res, public=True, max_age=Cover.REDIRECT_MAX_AGE)
+            else:
+                # 重定向只能缓存到签名过期之前
+                max_age = min(Cover.REDIRECT_MAX_AGE, int(expire - time.time()) - Cover.REDIRECT_EXPIRE_MARGIN)
+                if max_age > 0:
+                    patch_cache_control(res, public=True, max_age=max_age)
+                else:
+                    patch_cache_control(res, no_cache=True)
+        if negotiated:
+            patch_vary_headers(res, ('Accept',))
+        return res
 
     class Animation(viewsets.ViewSet):
         permission_classes = (app_permissions.IsStaff,)
@@ -163,26 +231,19 @@ class Cover(viewsets.ViewSet):
             if res is None:
                 return response.Response(status=404)
             file = request.FILES.get('cover')
-            name, ext = Cover.split_filename(file.name)
             content_type = file.content_type
             # 文件类型不对时返回400
             if content_type[:5] != 'image':
                 return response.Response(status=400)
-            old_cover_name = res.cover
             # 计算新文件名
             new_cover_name = '%s-%s-%s.%s' % ('animation', res.id, uuid.uuid4(), 'jpg')
-            if config.COVER_STORAGE['TYPE'] == 'oss':
-                Cover.analyse_save_oss(old_cover_name, new_cover_name, 'animation', ext, file.chunks())
-            else:
-                Cover.analyse_save_fs(old_cover_name, new_cover_name, 'animation', ext, file.chunks())
-            # 将文件名保存下来
-            res.cover = new_cover_name
-            res.save()
-            # 将文件名扩散到所有的缓存
-            app_relations.spread_cache_field(res.id, res.relations,
-                                             lambda id_list: app_models.Animation.objects.filter(id__in=id_list).all(),
-                                             'cover', new_cover_name)
-            return response.Response({'cover': new_cover_name}, status=201)
+            # 交给后台处理。完成后才会替换cover并扩散到所有的缓存
+            try:
+                app_covers.submit(res, new_cover_name, file)
+            except app_covers.ImageRejected as e:
+                raise app_exceptions.ApiError('ImageRejected', str(e))
+            return response.Response({'cover': res.cover, 'cover_pending': new_cover_name},
+                                     status=status.HTTP_202_ACCEPTED)
 
     class Profile(viewsets.ViewSet):
         @staticmethod
@@ -194,84 +255,19 @@ class Cover(viewsets.ViewSet):
             if not app_permissions.SelfOnly().has_object_permission(request, None, res):
                 return response.Response(status=403)
             file = request.FILES.get('cover')
-            name, ext = Cover.split_filename(file.name)
             content_type = file.content_type
             # 文件类型不对时返回400
             if content_type[:5] != 'image':
                 return HttpResponse(status=400)
-            old_cover_name = res.cover
             # 计算新文件名
             new_cover_name = '%s-%s-%s.%s' % ('profile', res.id, uuid.uuid4(), 'jpg')
-            if config.COVER_STORAGE['TYPE'] == 'oss':
-                Cover.analyse_save_oss(old_cover_name, new_cover_name, 'profile', ext, file.chunks())
-            else:
-                Cover.analyse_save_fs(old_cover_name, new_cover_name, 'profile', ext, file.chunks())
-            # 将文件名保存下来
-            res.cover = new_cover_name
-            res.save()
-            return response.Response({'cover': new_cover_name}, status=201)
-
-    @staticmethod
-    def analyse_save_fs(old_cover_name, new_cover_name, kind, ext, chunks):
-        # 删除旧的文件
-        if old_cover_name is not None:
-            old_path = '%s/%s' % (COVER_DIRS, old_cover_name)
-            if os.path.exists(old_path):
-                os.remove(old_path)
-        # 存储路径不存在时先创建路径
-        if not os.path.exists(COVER_DIRS):
-            os.makedirs(COVER_DIRS)
-        new_path = '%s/%s' % (COVER_DIRS, new_cover_name)
-        # 该文件万一已经存在，就删除文件
-        if os.path.exists(new_path):
-            os.remove(new_path)
-        # 将图像写入到一个临时的文件
-        temp_path = '%s/temp-%s-%s.%s' % (COVER_DIRS, kind, uuid.uuid4(), ext)
-        with open(temp_path, 'wb') as f:
-            for c in chunks:
-                f.write(c)
-        # 处理这张图片，对其进行裁切和缩放，然后写入到保存路径
-        Cover.analyse_image(temp_path, new_path)
-
-    @staticmethod
-    def analyse_save_oss(old_cover_name, new_cover_name, kind, ext, chunks):
-        from api.oss import bucket
-        # 删除旧的文件
-        if old_cover_name is not None:
-            bucket.delete_object(old_cover_name)
-        # 将图像写入到一个临时的文件
-        u = uuid.uuid4()
-        temp_path = '%s/temp-%s-%s.%s' % (COVER_DIRS, kind, u, ext)
-        temp_path_out = '%s/temp-%s-%s.out.%s' % (COVER_DIRS, kind, u, ext)
-        with open(temp_path, 'wb') as f:
-            for c in chunks:
-                f.write(c)
-        # 处理这张图片，对其进行裁切和缩放，然后写入到oss存储
-        Cover.analyse_image(temp_path, temp_path_out)
-        bucket.put_object_from_file(new_cover_name, temp_path_out)
-        os.remove(temp_path_out)
-
-    @staticmethod
-    def split_filename(filename):
-        p = filename.rfind('.')
-        if p >= 0:
-            return filename[:p], filename[p + 1:]
-        else:
-            return filename, ''
-
-    @staticmethod
-    def analyse_image(in_path, out_path, size=384):
-        img = Image.open(in_path)
-        # 裁剪成正方形
-        width, height = img.size
-        if width > height:
-            img = img.crop(((width - height) / 2, 0, (width + height) / 2, height))
-        elif width < height:
-            img = img.crop((0, (height - width) / 2, width, (height + width) / 2))
-        # 压缩到极小的尺寸
-        img.thumbnail((size, size))
-        img.convert('RGB').save(out_path)
-        os.remove(in_path)
+            # 交给后台处理。完成后才会替换cover
+            try:
+                app_covers.submit(res, new_cover_name, file)
+            except app_covers.ImageRejected as e:
+                raise app_exceptions.ApiError('ImageRejected', str(e))
+            return response.Response({'cover': res.cover, 'cover_pending': new_cover_name},
+                                     status=status.HTTP_202_ACCEPTED)
 
 
 class Profile:
@@ -317,17 +313,66 @@ class Profile:
         filter_fields = ('read', 'type')
         ordering_fields = ('id', 'read', 'type', 'create_time')
         ordering = '-create_time'
+        pagination_class = app_pagination.ListPagination
+        cursor_ordering_fields = ('id', 'create_time')
+
+        POLL_TIMEOUT = 30           # seconds
+        POLL_TIMEOUT_MAX = 60       # seconds
 
         def get_queryset(self):
             profile = self.request.user.profile
             queryset = self.queryset.filter(owner=profile)
             return queryset
 
+        def perform_update(self, serializer):
+            instance = serializer.instance
+            services.Message.set_read(instance, serializer.validated_data.get('read', instance.read))
+
         @action(detail=False, methods=['GET'])
         def unread_count(self, request):
-            count = self.get_queryset().filter(read=False).count()
+            count = services.Message.unread_count(request.user.profile)
+            return response.Response({'count': count})
+
+        @action(detail=False, methods=['POST'])
+        def mark_read(self, request):
+            """
+            批量标记已读。可以用until限定id的上界，用type限定消息类型；都不提供时标记全部消息。
+            """
+            serializer = app_serializers.Profile.MessageMarkRead(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            count = services.Message.mark_read(request.user.profile,
+                                               until=serializer.validated_data['until'],
+                                               message_type=serializer.validated_data['type'])
             return response.Response({'count': count})
 
+        @action(detail=False, methods=['GET'])
+        def poll(self, request):
+            """
+            长轮询。阻塞直到出现id大于since的新消息，或者超过timeout，然后返回这些新消息。
+            不提供since时，以请求时的最新消息为起点。
+            """
+            try:
+                since = request.query_params.get('since')
+                since = int(since) if since else None
+                timeout = min(float(request.query_params.get('timeout', self.POLL_TIMEOUT)), self.POLL_TIMEOUT_MAX)
+            except ValueError:
+                raise app_exceptions.ApiError('WrongParameterType', 'parameter "since" or "timeout" is wrong.')
+            profile = request.user.profile
+            # 先开始监听，再查询，避免遗漏两者之间产生的消息
+            mailbox = notify.get_mailbox()
+            if since is None:
+                since = self.get_queryset().aggregate(max_id=Max('id'))['max_id'] or 0
+                messages = []
+            else:
+                messages = list(self.get_queryset().filter(id__gt=since).order_by('id'))
+            if len(messages) <= 0 and timeout > 0:
+                # 等待期间归还数据库连接
+                db_connection.close()
+                if mailbox.wait(profile.id, since, timeout):
+                    messages = list(self.get_queryset().filter(id__gt=since).order_by('id'))
+            serializer = self.get_serializer(messages, many=True)
+            return response.Response(serializer.data)
+
 
 class Database:
     class Animation(viewsets.ModelViewSet):
@@ -336,17 +381,48 @@ class Database:
         permission_classes = (app_permissions.IsStaffOrReadOnly,)
         lookup_field = 'id'
         filterset_class = app_filters.Database.Animation
-        search_fields = ('title', 'origin_title', 'other_title', 'tags__name', 'keyword',
-                         'staff_companies__name', 'staff_supervisors__name', 'original_work_authors__name')
+        # search参数由搜索文档支持，搜索范围见services.Animation.DERIVED_FIELDS_SQL
+        filter_backends = (DjangoFilterBackend, app_filters.AnimationSearchFilter, filters.OrderingFilter)
         ordering_fields = ('id', 'title', 'original_work_type', 'publish_type', 'limit_level', 'publish_time', 'create_time', 'update_time')
+        pagination_class = app_pagination.ListPagination
+        estimate_count = True
+        cursor_ordering_fields = ('id', 'create_time', 'update_time')
+        FACETS_IGNORE_PARAMS = ('limit', 'offset', 'cursor', 'count', 'ordering')
+
+        def get_queryset(self):
+            # 预取序列化需要的全部多对多关系，列表的每一页只需要固定数量的查询
+            staffs = app_models.Staff.objects.only('id', 'name', 'is_organization')
+            prefetches = [Prefetch('tags', queryset=app_models.Tag.objects.only('id', 'name'))]
+            prefetches += [Prefetch(field, queryset=staffs) for field in app_models.Animation.STAFF_FIELDS]
+            queryset = self.queryset.prefetch_related(*prefetches).defer(*app_models.Animation.DERIVED_FIELDS)
+            if self.action == 'list':
+                queryset = queryset.defer(*self.serializer_class.SIMPLE_EXCLUDE)
+            return queryset
+
+        @action(detail=False, methods=['GET'])
+        def facets(self, request):
+            """
+            在与列表相同的筛选条件下，统计各分面每个值的animation数量。
+            """
+            cache = app_facets.get_cache()
+            key = cache.signature(request.query_params, ignore=self.FACETS_IGNORE_PARAMS)
+            result, generation = cache.get(key)
+            if result is None:
+                result = app_facets.count(self.filter_queryset(self.get_queryset()))
+                cache.put(key, result, generation)
+            return response.Response(result)
 
         def perform_create(self, serializer):
             serializer.validated_data['creator'] = self.request.user.username
             super().perform_create(serializer)
+            services.Animation.refresh_derived([serializer.instance.id])
+            services.Database.changed('animation', [serializer.instance.id])
 
         def perform_update(self, serializer):
             serializer.validated_data['updater'] = self.request.user.username
             super().perform_update(serializer)
+            services.Animation.refresh_derived([serializer.instance.id])
+            services.Database.changed('animation', [serializer.instance.id])
             if hasattr(serializer.instance, 'diaries'):
                 diaries = serializer.instance.diaries.all()
                 sum_quantity = serializer.instance.sum_quantity
@@ -367,7 +443,9 @@ class Database:
 
         def perform_destroy(self, instance):
             app_relations.remove_cache_instance(instance.id, instance.relations, lambda id_list: app_models.Animation.objects.filter(id__in=id_list).all())
+            animation_id = instance.id
             super().perform_destroy(instance)
+            services.Database.changed('animation', [animation_id])
 
     class Staff(viewsets.ModelViewSet):
         queryset = app_models.Staff.objects
@@ -381,10 +459,21 @@ class Database:
         def perform_create(self, serializer):
             serializer.validated_data['creator'] = self.request.user.username
             super().perform_create(serializer)
+            services.Database.changed('staff', [serializer.instance.id])
 
         def perform_update(self, serializer):
             serializer.validated_data['updater'] = self.request.user.username
             super().perform_update(serializer)
+            if 'name' in serializer.validated_data:
+                services.Animation.refresh_derived(services.Animation.ids_by_staff(serializer.instance))
+            services.Database.changed('staff', [serializer.instance.id])
+
+        def perform_destroy(self, instance):
+            id_list = list(services.Animation.ids_by_staff(instance))
+            staff_id = instance.id
+            super().perform_destroy(instance)
+            services.Animation.refresh_derived(id_list)
+            services.Database.changed('staff', [staff_id])
 
     class Tag(viewsets.ModelViewSet):
         queryset = app_models.Tag.objects
@@ -398,10 +487,54 @@ class Database:
         def perform_create(self, serializer):
             serializer.validated_data['creator'] = self.request.user.username
             super().perform_create(serializer)
+            services.Database.changed('tag', [serializer.instance.id])
 
         def perform_update(self, serializer):
             serializer.validated_data['updater'] = self.request.user.username
             super().perform_update(serializer)
+            if 'name' in serializer.validated_data:
+                services.Animation.refresh_derived(serializer.instance.animations.values_list('id', flat=True))
+            services.Database.changed('tag', [serializer.instance.id])
+
+        def perform_destroy(self, instance):
+            id_list = list(instance.animations.values_list('id', flat=True))
+            tag_id = instance.id
+            super().perform_destroy(instance)
+            services.Animation.refresh_derived(id_list)
+            services.Database.changed('tag', [tag_id])
+
+    class Suggest(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaffOrReadOnly,)
+        DEFAULT_LIMIT = 10
+        MAX_LIMIT = 50
+
+        @staticmethod
+        def list(request):
+            """
+            输入提示。在animation标题、tag名和staff名中查找q的前缀匹配与子串匹配。
+            可以用type参数(逗号分隔)限定条目类型。
+            """
+            text = request.query_params.get('q', '')
+            try:
+                limit = max(1, min(int(request.query_params.get('limit', Database.Suggest.DEFAULT_LIMIT)),
+                                   Database.Suggest.MAX_LIMIT))
+            except ValueError:
+                raise app_exceptions.ApiError('WrongParameterType', 'parameter "limit" must be int.')
+            kinds = request.query_params.get('type')
+            kinds = tuple(kinds.split(',')) if kinds else app_suggest.KINDS
+            return response.Response(app_suggest.get_index().search(text, limit, kinds))
+
+
+def joined_animation_queryset(queryset, animation_fields):
+    """
+    在一次查询中join关联的animation，且只取出animation_fields中的列。
+    :param queryset: 持有animation外键的model的queryset。
+    :param animation_fields:
+    :return:
+    """
+    fields = [field.name for field in queryset.model._meta.concrete_fields]
+    fields += ['animation__%s' % (field,) for field in animation_fields]
+    return queryset.select_related('animation').only(*fields)
 
 
 class Personal:
@@ -412,11 +545,21 @@ class Personal:
         lookup_field = 'animation_id'
         filterset_class = app_filters.Personal.Diary
         search_fields = ('animation__title',)
-        ordering_fields = ('id', 'animation__title', 'watched_quantity', 'sum_quantity', 'published_quantity', 'status',
-                           'create_time', 'update_time', 'finish_time')
+        ordering_fields = ('id', 'title', 'animation__title', 'watched_quantity', 'sum_quantity', 'published_quantity',
+                           'status', 'create_time', 'update_time', 'finish_time')
+        pagination_class = app_pagination.ListPagination
+        cursor_ordering_fields = ('id', 'create_time', 'update_time', 'finish_time')
 
         def get_queryset(self):
-            return self.queryset.filter(owner=self.request.user.profile).all()
+            queryset = joined_animation_queryset(self.queryset.filter(owner=self.request.user.profile),
+                                                 self.serializer_class.ANIMATION_FIELDS)
+            # 将join的animation字段标注到diary上，以支持按这些字段过滤和排序
+            queryset = queryset.annotate(title=F('animation__title'),
+                                         sum_quantity=F('animation__sum_quantity'),
+                                         published_quantity=F('animation__published_quantity'))
+            if self.action == 'list':
+                queryset = queryset.defer(*self.serializer_class.SIMPLE_EXCLUDE)
+            return queryset.all()
 
     class Comment(viewsets.ModelViewSet):
         queryset = app_models.Comment.objects
@@ -428,7 +571,8 @@ class Personal:
         ordering_fields = ('id', 'animation__title', 'score', 'create_time', 'update_time')
 
         def get_queryset(self):
-            return self.queryset.filter(owner=self.request.user.profile).all()
+            return joined_animation_queryset(self.queryset.filter(owner=self.request.user.profile),
+                                             self.serializer_class.ANIMATION_FIELDS).all()
 
 
 class Statistics(viewsets.ViewSet):
@@ -484,6 +628,20 @@ class Statistics(viewsets.ViewSet):
 
 
 class Admin:
+    class CoverStats(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
+        @staticmethod
+        def list(request):
+            """
+            当前服务进程中封面相关的统计：签名URL缓存的命中情况，以及图片处理的耗时。
+            """
+            data = {'processing': app_covers.stats.snapshot()}
+            if isinstance(app_storage.get_storage(), app_storage.OssStorage):
+                from api.oss import sign_cache
+                data['sign_cache'] = sign_cache.stats()
+            return response.Response(data)
+
     class Setting(viewsets.ViewSet):
         serializer_class = app_serializers.Admin.Setting
         permission_classes = (app_permissions.IsStaff,)
@@ -537,3 +695,19 @@ class Admin:
         filter_fields = ('read', 'owner__username')
         ordering_fields = ('read', 'owner', 'create_time')
         ordering = '-create_time'
+
+    class Broadcast(mixins.ListModelMixin, mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                    viewsets.GenericViewSet):
+        queryset = app_models.Broadcast.objects
+        serializer_class = app_serializers.Admin.Broadcast
+        permission_classes = (app_permissions.IsStaff,)
+        lookup_field = 'id'
+        filter_fields = ('status', 'staff_only')
+        ordering_fields = ('status', 'create_time', 'finish_time')
+        ordering = '-create_time'
+
+        def perform_create(self, serializer):
+            serializer.validated_data['creator'] = self.request.user.username
+            super().perform_create(serializer)
+            broadcast = serializer.instance
+            transaction.on_commit(lambda: services.Broadcast.start(broadcast))